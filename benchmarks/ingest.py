@@ -0,0 +1,369 @@
+"""Importer ingest benchmark.
+
+Generates synthetic Zeebe record streams and applies them
+
+* through ``importer.decode_entries``, as stored in the streams (CPU per
+  entry and peak memory of the decoded records),
+* through the projections in ``importer.ZEEBE_EVENT_ROWS`` only, building
+  the (statement, params) rows without executing them (per record type CPU
+  cost),
+* record by record through ``importer.handle_zeebe_event`` (per handler
+  latencies), and
+* through ``importer.main`` reading them from an in-process fake Redis, or
+  from a real Redis with ``--redis-url``.
+
+Usage::
+
+    python -m benchmarks.ingest --instances 1000 --output ingest.json
+"""
+import asyncio
+import glob
+import json
+import os
+import platform
+import shlex
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from unittest import mock
+
+import apsw
+import click
+import redis
+import redis.asyncio
+
+import importer
+from benchmarks.zeebe import FakeRedis, Generator, load, parse_id, stream_entries
+
+
+class Drained(BaseException):
+    pass
+
+
+def committed_ids(path):
+    # The stream checkpoints committed to the database the run writes.
+    if not os.path.exists(path):
+        return {}
+    connection = apsw.Connection(path, flags=apsw.SQLITE_OPEN_READONLY)
+    try:
+        return dict(connection.execute("SELECT stream, id FROM checkpoint"))
+    except apsw.SQLError:
+        return {}
+    finally:
+        connection.close()
+
+
+class UntilDrained:
+    """Raises Drained once the importer has committed every generated entry.
+
+    The importer reads ahead of what it committed, so an empty read only
+    ends the run when the checkpoints of the database reach the last entry
+    of every stream.
+    """
+
+    def __init__(self, r, last_ids, path):
+        self.r = r
+        self.last_ids = last_ids
+        self.path = path
+        self.streams = set()
+        self.drained_at = None
+
+    def drained(self):
+        committed = committed_ids(self.path)
+        if all(
+            name.decode("utf-8") in committed
+            and parse_id(committed[name.decode("utf-8")]) >= parse_id(last_id)
+            for name, last_id in self.last_ids.items()
+            # Of the streams the importer reads.
+            if name in self.streams
+        ):
+            self.drained_at = time.perf_counter()
+            raise Drained()
+
+    def xread(self, streams, count=None, block=None):
+        self.streams.update(streams)
+        result = self.r.xread(streams, count=count, block=block and 100)
+        if not result:
+            self.drained()
+            if block:
+                time.sleep(0.01)
+        return result
+
+    def publish(self, channel, message):
+        return self.r.publish(channel, message)
+
+    def close(self):
+        self.r.close()
+
+
+class AsyncUntilDrained:
+    """UntilDrained for the redis.asyncio client of importer --async."""
+
+    def __init__(self, client, r):
+        self.client = client
+        self.r = r
+
+    async def ping(self):
+        return True
+
+    async def xread(self, streams, count=None, block=None):
+        self.client.streams.update(streams)
+        result = self.r.xread(streams, count=count, block=block and 100)
+        if asyncio.iscoroutine(result):
+            result = await result
+        if not result:
+            self.client.drained()
+            if block:
+                await asyncio.sleep(0.01)
+        return result
+
+    async def close(self):
+        pass
+
+
+def percentiles(latencies):
+    count = len(latencies)
+    if count < 2:
+        latencies = latencies * 2
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "count": count,
+        "p50_us": round(quantiles[49] / 1000, 2),
+        "p99_us": round(quantiles[98] / 1000, 2),
+    }
+
+
+def db_size(path):
+    # Including the shards of importer --shards.
+    return sum(
+        os.path.getsize(name)
+        for name in glob.glob(glob.escape(path) + "*")
+        if not name.endswith("-shm")
+    )
+
+
+def bench_decode(entries, repeat=3):
+    streams = defaultdict(list)
+    for stream, id_, record in entries:
+        streams[stream.encode("utf-8")].append(
+            (id_.encode("utf-8"), {b"record": json.dumps(record).encode("utf-8")})
+        )
+    importer.DEFINITIONS.entries.clear()
+    seconds = []
+    for _ in range(repeat):
+        started = time.process_time()
+        for stream_name, stream_items in streams.items():
+            importer.decode_entries(
+                importer.zeebe_event_type(stream_name), stream_items
+            )
+        seconds.append(time.process_time() - started)
+    tracemalloc.start()
+    decoded = [
+        importer.decode_entries(importer.zeebe_event_type(stream_name), stream_items)
+        for stream_name, stream_items in streams.items()
+    ]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "entries": len(entries),
+        "events": sum(len(records) for records in decoded),
+        "cpu_us_per_entry": round(min(seconds) / len(entries) * 1e6, 2),
+        "peak_bytes": peak,
+        "json": importer.orjson is not None and "orjson" or "json",
+    }
+
+
+def bench_rows(entries, path, repeat=3):
+    importer.DEFINITIONS.entries.clear()
+    connection = importer.connect(path)
+    importer.init_db(connection)
+    events = [
+        (
+            importer.zeebe_event_type(stream.encode("utf-8")),
+            importer.event_from_record(record),
+        )
+        for stream, _, record in entries
+        if record["recordType"] == "EVENT"
+    ]
+    with connection:
+        # Definitions for the element names of element instances.
+        for event_type, record in events:
+            if event_type == "process":
+                importer.handle_zeebe_event(connection, event_type, None, record)
+    latencies = defaultdict(list)
+    for _ in range(repeat):
+        for event_type, record in events:
+            rows = importer.ZEEBE_EVENT_ROWS[event_type]
+            start = time.perf_counter_ns()
+            rows(record, connection)
+            latencies[event_type].append(time.perf_counter_ns() - start)
+    connection.close()
+    return {
+        name: dict(
+            percentiles(values), mean_us=round(statistics.mean(values) / 1000, 2)
+        )
+        for name, values in sorted(latencies.items())
+    }
+
+
+def bench_handlers(entries, path, batch_size):
+    importer.DEFINITIONS.entries.clear()
+    connection = importer.connect(path)
+    importer.init_db(connection)
+    latencies = defaultdict(list)
+    events = [
+        (
+            importer.zeebe_event_type(stream.encode("utf-8")),
+            importer.event_from_record(record),
+        )
+        for stream, _, record in entries
+        if record["recordType"] == "EVENT"
+    ]
+    started = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        with connection:
+            for event_type, record in events[i : i + batch_size]:
+                start = time.perf_counter_ns()
+                importer.handle_zeebe_event(connection, event_type, None, record)
+                latencies[f"handle_{event_type}"].append(time.perf_counter_ns() - start)
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return {
+        "events": len(events),
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(len(events) / elapsed),
+        "latency": {
+            name: percentiles(values) for name, values in sorted(latencies.items())
+        },
+        "db_bytes": db_size(path),
+    }
+
+
+def bench_main(entries, path, redis_url, importer_args):
+    r = redis.Redis.from_url(redis_url) if redis_url else FakeRedis()
+    if redis_url:
+        r.delete(*{stream for stream, _, _ in entries})
+    load(r, entries)
+    last_ids = {}
+    for stream, id_, _ in entries:
+        last_ids[stream.encode("utf-8")] = id_
+    params = importer.main.make_context(
+        "importer", ["--db", path, *shlex.split(importer_args)], resilient_parsing=True
+    ).params
+    # --shard I writes <db>-shard<I>, whose checkpoints alone say that this
+    # run has drained the streams.
+    written = path
+    if params["shard"] is not None:
+        written = importer.shard_paths(path, params["shards"])[params["shard"]]
+    client = UntilDrained(r, last_ids, written)
+    async_client = AsyncUntilDrained(
+        client, redis.asyncio.Redis.from_url(redis_url) if redis_url else r
+    )
+    importer.DEFINITIONS.entries.clear()
+    started = time.perf_counter()
+    with mock.patch.object(
+        redis.Redis, "from_url", lambda *args, **kwargs: client
+    ), mock.patch.object(
+        redis.asyncio.Redis, "from_url", lambda *args, **kwargs: async_client
+    ):
+        try:
+            importer.main.main(
+                ["--db", path, *shlex.split(importer_args)], standalone_mode=False
+            )
+        except Drained:
+            pass
+    # Not counting the reconnect delay of --async after Drained.
+    elapsed = client.drained_at - started
+    return {
+        "entries": len(entries),
+        "seconds": round(elapsed, 3),
+        "entries_per_second": round(len(entries) / elapsed),
+        "db_bytes": db_size(path),
+    }
+
+
+@click.command()
+@click.option("--instances", default=1000, show_default=True)
+@click.option("--processes", default=10, show_default=True)
+@click.option("--partitions", default=3, show_default=True)
+@click.option("--concurrency", default=50, show_default=True)
+@click.option("--payload-size", default=256, show_default=True)
+@click.option("--incident-ratio", default=0.05, show_default=True)
+@click.option("--command-ratio", default=0.5, show_default=True)
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option(
+    "--redis-url",
+    default=None,
+    help="Benchmark main() against this Redis instead of the in-process fake. "
+    "Its zeebe:* streams are replaced.",
+)
+@click.option("--importer-args", default="", help="Extra options for importer main().")
+@click.option("--output", type=click.File("w"), default="-")
+def benchmark(
+    instances,
+    processes,
+    partitions,
+    concurrency,
+    payload_size,
+    incident_ratio,
+    command_ratio,
+    batch_size,
+    redis_url,
+    importer_args,
+    output,
+):
+    options = {arg.partition("=")[0] for arg in shlex.split(importer_args)}
+    # The shard processes and the consumer group read Redis on their own.
+    if "--shards" in options and "--shard" not in options:
+        raise click.UsageError("Benchmark one shard at a time, with --shard.")
+    if "--consumer-group" in options:
+        raise click.UsageError("--consumer-group is not supported.")
+    parameters = dict(
+        instances=instances,
+        processes=processes,
+        partitions=partitions,
+        concurrency=concurrency,
+        payload_size=payload_size,
+        incident_ratio=incident_ratio,
+        command_ratio=command_ratio,
+    )
+    entries = list(stream_entries(Generator(**parameters)))
+    importer.logging.getLogger().setLevel("WARNING")
+    with tempfile.TemporaryDirectory() as tmp:
+        decode = bench_decode(entries)
+        rows = bench_rows(entries, os.path.join(tmp, "rows.db"))
+        handlers = bench_handlers(entries, os.path.join(tmp, "handlers.db"), batch_size)
+        main = bench_main(
+            entries,
+            os.path.join(tmp, "main.db"),
+            redis_url,
+            f"--batch-size {batch_size} {importer_args}",
+        )
+    json.dump(
+        {
+            "parameters": dict(
+                parameters,
+                batch_size=batch_size,
+                redis=redis_url and "redis" or "fake",
+                importer_args=importer_args,
+            ),
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": apsw.sqlitelibversion(),
+                "apsw": apsw.apswversion(),
+            },
+            "decode_entries": decode,
+            "rows": rows,
+            "handle_zeebe_event": handlers,
+            "main": main,
+        },
+        output,
+        indent=2,
+    )
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    benchmark()
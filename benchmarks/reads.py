@@ -0,0 +1,553 @@
+"""Read side benchmark.
+
+Builds a synthetic ``dbfile`` of ``--instances`` process instances through
+``importer.init_db`` and ``importer.handle_zeebe_event`` (or opens the one
+given with ``--db``) and runs
+
+* the queries of the ``metadata.yaml`` dashboard charts and canned queries,
+  and
+* the SQL datasette-graphql runs for the relations of the ``Dashboard.ipynb``
+  GraphQL queries,
+
+over ``--samples`` sampled process instances, jobs and definitions, reporting
+the EXPLAIN QUERY PLAN and the p50/p99 latency of every query. The run fails
+(exit status 1) when a query scans an instance table in full, does not use
+its index, exceeds its latency budget or, with ``--baseline``, got slower
+than ``--tolerance`` times its p50 latency of an earlier run.
+
+Usage::
+
+    python -m benchmarks.reads --instances 100000 --output reads.json
+"""
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+import apsw
+import click
+import yaml
+
+import importer
+from benchmarks.ingest import db_size
+from benchmarks.zeebe import Generator
+
+# The index a query reads, None for any index, or WHOLE_TABLE for the queries
+# that read their table in key order or count it by design.
+WHOLE_TABLE = "whole table"
+
+# datasette's default sql_time_limit_ms, after which it cancels a query.
+WHOLE_TABLE_BUDGET_MS = 1000.0
+
+# The target of the full text searches of open tasks and incidents.
+SEARCH_BUDGET_MS = 50.0
+
+# Tables that grow with the number of process instances.
+INSTANCE_TABLES = importer.ARCHIVED_TABLES + ["process_instance", "payload"]
+
+# Scanning a partial index of the open rows is not a full scan.
+PARTIAL_INDEXES = {
+    name for name, statement in importer.INDEXES.items() if " where " in statement
+}
+
+PROCESS_INSTANCE_COLUMNS = (
+    "[key], processDefinition, parentProcessInstance, parentElementInstance,"
+    " state, created, updated, completed"
+)
+ELEMENT_INSTANCE_COLUMNS = (
+    "[key], processInstance, elementId, elementName, bpmnElementType,"
+    " flowScopeKey, state, created, updated, completed"
+)
+INCIDENT_COLUMNS = (
+    "[key], job, processInstance, processDefinition, elementInstance, elementId,"
+    " errorMessage, errorType, state, created, updated, completed"
+)
+JOB_COLUMNS = (
+    "[key], type, processInstance, processDefinition, elementInstance,"
+    " customHeaders, variables, form, worker, errorCode, errorMessage, state,"
+    " retryBackoff, recurringTime, retries, deadline, created, updated, completed"
+)
+DECISION_EVALUATION_COLUMNS = (
+    "[key], processInstance, processDefinition, elementInstance,"
+    " decisionRequirements, decision, decisionOutput, evaluatedDecisions, state,"
+    " created, updated, completed"
+)
+
+# The SQL datasette-graphql runs for the Dashboard.ipynb queries: every table
+# and relation is a page (first: N fetches N + 1 rows) and a count(*) of its
+# filter, and every foreign key a lookup by key.
+GRAPHQL_QUERIES = [
+    # QUERY_RESOURCE
+    (
+        "resource_base64",
+        'select hash, resource from resource_base64 where "hash" = :resource'
+        " order by hash limit 11",
+        None,
+    ),
+    # QUERY_DEFINITIONS
+    (
+        "process",
+        "select [key], bpmnProcessId, bpmnProcessName, version, resourceName,"
+        " resource, state, created, updated from process"
+        " order by bpmnProcessName limit 11",
+        None,
+    ),
+    # QUERY_INSTANCES, QUERY_ACTIVE_INSTANCES and QUERY_COMPLETED_INSTANCES
+    (
+        "process_instance",
+        f"select {PROCESS_INSTANCE_COLUMNS} from process_instance"
+        " order by [key] limit 101",
+        WHOLE_TABLE,
+    ),
+    (
+        "process_instance totalCount",
+        "select count(*) from process_instance",
+        WHOLE_TABLE,
+    ),
+    (
+        "process_instance running",
+        f"select {PROCESS_INSTANCE_COLUMNS} from process_instance"
+        ' where "completed" is null order by [key] limit 101',
+        "process_instance_open_key",
+    ),
+    (
+        "process_instance running totalCount",
+        'select count(*) from process_instance where "completed" is null',
+        None,
+    ),
+    # Most instances are completed, so the page ends early.
+    (
+        "process_instance completed",
+        f"select {PROCESS_INSTANCE_COLUMNS} from process_instance"
+        ' where "completed" is not null order by [key] limit 101',
+        WHOLE_TABLE,
+    ),
+    (
+        "process_instance completed totalCount",
+        'select count(*) from process_instance where "completed" is not null',
+        WHOLE_TABLE,
+    ),
+    (
+        "process_instance.processDefinition",
+        "select * from [process] where [key] = :process",
+        None,
+    ),
+    (
+        "process_instance.tasks",
+        f"select {ELEMENT_INSTANCE_COLUMNS} from element_instance"
+        ' where "bpmnElementType" = :element_type and "completed" is null'
+        ' and "processInstance" = :running order by [key] limit 11',
+        "element_instance_process_instance",
+    ),
+    (
+        "process_instance.tasks totalCount",
+        "select count(*) from element_instance"
+        ' where "bpmnElementType" = :element_type and "completed" is null'
+        ' and "processInstance" = :running',
+        "element_instance_process_instance",
+    ),
+    (
+        "process_instance.incidents",
+        f"select {INCIDENT_COLUMNS} from incident"
+        ' where "completed" is null and "processInstance" = :running'
+        " order by [key] limit 11",
+        "incident_process_instance",
+    ),
+    (
+        "process_instance.incidents totalCount",
+        "select count(*) from incident"
+        ' where "completed" is null and "processInstance" = :running',
+        "incident_process_instance",
+    ),
+    # QUERY_INSTANCE
+    (
+        "process_instance_row",
+        f"select {PROCESS_INSTANCE_COLUMNS} from process_instance"
+        ' where "key" = :instance order by [key] limit 2',
+        None,
+    ),
+    (
+        "process_instance_row.activities",
+        f"select {ELEMENT_INSTANCE_COLUMNS} from element_instance"
+        ' where "processInstance" = :instance order by [key] limit 11',
+        "element_instance_process_instance",
+    ),
+    (
+        "process_instance_row.activities totalCount",
+        'select count(*) from element_instance where "processInstance" = :instance',
+        "element_instance_process_instance",
+    ),
+    (
+        "process_instance_row.incidents",
+        f"select {INCIDENT_COLUMNS} from incident"
+        ' where "processInstance" = :instance order by [key] limit 11',
+        "incident_process_instance",
+    ),
+    (
+        "process_instance_row.incidents totalCount",
+        'select count(*) from incident where "processInstance" = :instance',
+        "incident_process_instance",
+    ),
+    # QUERY_JOBS
+    (
+        "job",
+        f"select {JOB_COLUMNS} from job"
+        ' where "completed" is null and "state" != :state order by [key] limit 1001',
+        "job_open_key",
+    ),
+    (
+        "job totalCount",
+        'select count(*) from job where "completed" is null and "state" != :state',
+        None,
+    ),
+    (
+        "job.processInstance",
+        "select * from [process_instance] where [key] = :instance",
+        None,
+    ),
+    (
+        "job.elementInstance",
+        "select * from [element_instance] where [key] = :element_instance",
+        None,
+    ),
+    # QUERY_JOB
+    (
+        "job_row",
+        f'select {JOB_COLUMNS} from job where "key" = :job order by [key] limit 2',
+        None,
+    ),
+    (
+        "job_full",
+        f'select {JOB_COLUMNS} from job_full where "key" = :job'
+        " order by [key] limit 11",
+        None,
+    ),
+    # QUERY_DECISIONS and QUERY_DECISION
+    (
+        "decision_evaluation",
+        f"select {DECISION_EVALUATION_COLUMNS} from decision_evaluation"
+        " order by [key] limit 1001",
+        WHOLE_TABLE,
+    ),
+    (
+        "decision_evaluation totalCount",
+        "select count(*) from decision_evaluation",
+        WHOLE_TABLE,
+    ),
+    (
+        "decision_evaluation.decision",
+        "select * from [decision] where [key] = :decision",
+        None,
+    ),
+    (
+        "decision_evaluation.decisionRequirements",
+        "select * from [decision_requirements] where [key] = :decision_requirements",
+        None,
+    ),
+    (
+        "decision_evaluation_row",
+        f"select {DECISION_EVALUATION_COLUMNS} from decision_evaluation"
+        ' where "key" = :decision_evaluation order by [key] limit 2',
+        None,
+    ),
+]
+
+SAMPLES = {
+    "instance": "SELECT key FROM process_instance",
+    "running": "SELECT key FROM process_instance WHERE completed IS NULL",
+    "process": "SELECT key FROM process",
+    "resource": "SELECT resource FROM process",
+    "element_instance": "SELECT elementInstance FROM job WHERE completed IS NULL",
+    "job": "SELECT key FROM job WHERE completed IS NULL",
+    "decision": "SELECT key FROM decision",
+    "decision_requirements": "SELECT key FROM decision_requirements",
+    "decision_evaluation": "SELECT key FROM decision_evaluation",
+    # Element names and error messages as FTS5 phrases, matching open tasks
+    # and incidents or not.
+    "search": "SELECT '\"' || replace(value, '\"', '\"\"') || '\"' FROM ("
+    "SELECT elementName AS value FROM element_instance"
+    " UNION ALL SELECT errorMessage FROM incident) WHERE value IS NOT NULL",
+}
+
+TABLE_ALIAS = re.compile(
+    r"\b(?:from|join)\s+\[?(\w+)\]?(?:\s+(?:as\s+)?(?!where|on|order|group|join|limit)(\w+))?",
+    re.IGNORECASE,
+)
+
+
+def metadata_queries(path):
+    with open(path) as metadata:
+        metadata = yaml.safe_load(metadata)
+    dashboards = metadata["plugins"]["datasette-dashboards"]
+    queries = metadata["databases"]["dbfile"].get("queries", {})
+    return [
+        (f"chart {name}", chart["query"].strip(), None)
+        for dashboard in dashboards.values()
+        for name, chart in dashboard["charts"].items()
+        if chart.get("db", "dbfile") == "dbfile"
+    ] + [(f"query {name}", query["sql"], None) for name, query in queries.items()]
+
+
+def build(path, generator, batch_size, schema):
+    importer.DEFINITIONS.entries.clear()
+    connection = importer.connect(path)
+    importer.init_db(connection)
+    events = (
+        (
+            importer.zeebe_event_type(stream.encode("utf-8")),
+            importer.event_from_record(record),
+        )
+        for stream, record in generator
+        if record["recordType"] == "EVENT"
+    )
+    started = time.perf_counter()
+    count = 0
+    done = False
+    while not done:
+        with connection:
+            for _ in range(batch_size):
+                event = next(events, None)
+                if event is None:
+                    done = True
+                    break
+                importer.handle_zeebe_event(connection, event[0], None, event[1])
+                count += 1
+    if schema == 2:
+        importer.migrate_schema(connection, pause=0)
+    connection.cursor().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return {
+        "events": count,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def sample(connection, samples):
+    cursor = connection.cursor()
+    values = {
+        name: [
+            value
+            for (value,) in cursor.execute(
+                f"{query} ORDER BY random() LIMIT ?", (samples,)
+            )
+        ]
+        or [None]
+        for name, query in SAMPLES.items()
+    }
+    return [
+        dict(
+            {name: column[i % len(column)] for name, column in values.items()},
+            element_type="USER_TASK",
+            state="COMPLETED",
+        )
+        for i in range(samples)
+    ]
+
+
+def plan_failures(plan, query, index):
+    aliases = {}
+    for table, alias in TABLE_ALIAS.findall(query):
+        aliases[table] = aliases[alias or table] = table
+    failures = []
+    if index not in (None, WHOLE_TABLE) and not any(
+        index in detail.split() for detail in plan
+    ):
+        failures.append(f"does not use index {index}")
+    for detail in plan:
+        words = detail.split()
+        if words[0] != "SCAN" or index == WHOLE_TABLE:
+            continue
+        if aliases.get(words[1], words[1]) not in INSTANCE_TABLES:
+            continue
+        if words[-1] in PARTIAL_INDEXES:
+            continue
+        failures.append(f"full scan: {detail}")
+    return failures
+
+
+def percentiles(latencies):
+    quantiles = statistics.quantiles(latencies * 2, n=100, method="inclusive")
+    return {
+        "p50_ms": round(quantiles[49] / 1e6, 3),
+        "p99_ms": round(quantiles[98] / 1e6, 3),
+    }
+
+
+def bench_query(connection, query, parameters):
+    cursor = connection.cursor()
+    rows = 0
+    latencies = []
+    # The first run warms the page cache.
+    for params in parameters[:1] + parameters:
+        start = time.perf_counter_ns()
+        rows = len(cursor.execute(query, params).fetchall())
+        latencies.append(time.perf_counter_ns() - start)
+    return dict(percentiles(latencies[1:]), rows=rows)
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        # Differences under 0.1 ms are noise.
+        limit = max(previous["p50_ms"] * tolerance, previous["p50_ms"] + 0.1)
+        if result["p50_ms"] > limit:
+            failures.append(f"p50 {result['p50_ms']} ms, was {previous['p50_ms']} ms")
+            result.setdefault("failures", []).append(failures[-1])
+    return failures
+
+
+@click.command()
+@click.option("--instances", default=100000, show_default=True)
+@click.option("--processes", default=10, show_default=True)
+@click.option("--partitions", default=3, show_default=True)
+@click.option("--concurrency", default=50, show_default=True)
+@click.option("--payload-size", default=256, show_default=True)
+@click.option("--incident-ratio", default=0.05, show_default=True)
+@click.option("--running-ratio", default=0.01, show_default=True)
+@click.option("--batch-size", default=10000, show_default=True)
+@click.option("--schema", type=click.IntRange(1, 2), default=1, show_default=True)
+@click.option(
+    "--db",
+    default=None,
+    help="Benchmark this database. It is built if it does not exist.",
+)
+@click.option(
+    "--metadata",
+    type=click.Path(exists=True, dir_okay=False),
+    default=os.path.join(os.path.dirname(os.path.dirname(__file__)), "metadata.yaml"),
+    show_default=True,
+)
+@click.option("--samples", default=200, show_default=True)
+@click.option(
+    "--budget-ms",
+    default=10.0,
+    show_default=True,
+    help="p99 latency budget of a query.",
+)
+@click.option(
+    "--baseline",
+    type=click.File("r"),
+    default=None,
+    help="Fail queries whose p50 latency got --tolerance times slower than "
+    "in this earlier output.",
+)
+@click.option("--tolerance", default=2.0, show_default=True)
+@click.option("--output", type=click.File("w"), default="-")
+def benchmark(
+    instances,
+    processes,
+    partitions,
+    concurrency,
+    payload_size,
+    incident_ratio,
+    running_ratio,
+    batch_size,
+    schema,
+    db,
+    metadata,
+    samples,
+    budget_ms,
+    baseline,
+    tolerance,
+    output,
+):
+    parameters = dict(
+        instances=instances,
+        processes=processes,
+        partitions=partitions,
+        concurrency=concurrency,
+        payload_size=payload_size,
+        incident_ratio=incident_ratio,
+        command_ratio=0.0,
+        running_ratio=running_ratio,
+    )
+    importer.logging.getLogger().setLevel("WARNING")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = db or os.path.join(tmp, "dbfile")
+        built = None
+        if not os.path.exists(path):
+            built = build(path, Generator(**parameters), batch_size, schema)
+        connection = importer.connect(path)
+        importer.init_db(connection)
+        cursor = connection.cursor()
+        counts = {
+            table: cursor.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+            for table in ["process_instance", *importer.ARCHIVED_TABLES]
+        }
+        running = cursor.execute(
+            "SELECT count(*) FROM process_instance WHERE completed IS NULL"
+        ).fetchone()[0]
+        params = sample(connection, samples)
+        results = {}
+        failures = []
+        for name, query, index in metadata_queries(metadata) + GRAPHQL_QUERIES:
+            plan = [
+                row[-1]
+                for row in cursor.execute("EXPLAIN QUERY PLAN " + query, params[0])
+            ]
+            result = dict(
+                {"query": query, "index": index, "plan": plan},
+                **bench_query(connection, query, params),
+            )
+            if index == WHOLE_TABLE:
+                result["budget_ms"] = WHOLE_TABLE_BUDGET_MS
+            elif ":search" in query:
+                result["budget_ms"] = max(budget_ms, SEARCH_BUDGET_MS)
+            else:
+                result["budget_ms"] = budget_ms
+            query_failures = plan_failures(plan, query, index)
+            if result["p99_ms"] > result["budget_ms"]:
+                query_failures.append(f"p99 {result['p99_ms']} ms over budget")
+            if query_failures:
+                result["failures"] = query_failures
+                failures.extend(query_failures)
+            results[name] = result
+        if baseline is not None:
+            failures.extend(compare(results, json.load(baseline)["queries"], tolerance))
+        database = {
+            "schema": importer.schema_version(connection),
+            "rows": counts,
+            "running_process_instances": running,
+            "db_bytes": db_size(path),
+            "build": built,
+        }
+        connection.close()
+    json.dump(
+        {
+            "parameters": dict(
+                parameters,
+                batch_size=batch_size,
+                db=db,
+                samples=samples,
+                budget_ms=budget_ms,
+            ),
+            "environment": {
+                "python": platform.python_version(),
+                "sqlite": apsw.sqlitelibversion(),
+                "apsw": apsw.apswversion(),
+            },
+            "database": database,
+            "queries": results,
+            "failures": len(failures),
+        },
+        output,
+        indent=2,
+    )
+    output.write("\n")
+    if failures:
+        for name, result in results.items():
+            for failure in result.get("failures", []):
+                click.echo(f"{name}: {failure}", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
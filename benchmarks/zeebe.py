@@ -0,0 +1,536 @@
+import base64
+import bisect
+import itertools
+import json
+import random
+
+PARTITION_BITS = 51
+
+BPMN = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<bpmn:definitions xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL" xmlns:zeebe="http://camunda.org/schema/zeebe/1.0" id="Definitions_{n}" targetNamespace="http://bpmn.io/schema/bpmn">
+  <bpmn:process id="{process_id}" name="Benchmark process {n}" isExecutable="true">
+    <bpmn:extensionElements>
+      <zeebe:userTaskForm id="userTaskForm_{n}">{form}</zeebe:userTaskForm>
+    </bpmn:extensionElements>
+    <bpmn:startEvent id="start" name="Start"/>
+    <bpmn:sequenceFlow id="flow_1" sourceRef="start" targetRef="service"/>
+    <bpmn:serviceTask id="service" name="Call service">
+      <bpmn:extensionElements>
+        <zeebe:taskDefinition type="benchmark-service"/>
+      </bpmn:extensionElements>
+    </bpmn:serviceTask>
+    <bpmn:sequenceFlow id="flow_2" sourceRef="service" targetRef="decide"/>
+    <bpmn:businessRuleTask id="decide" name="Decide">
+      <bpmn:extensionElements>
+        <zeebe:calledDecision decisionId="decision" resultVariable="result"/>
+      </bpmn:extensionElements>
+    </bpmn:businessRuleTask>
+    <bpmn:sequenceFlow id="flow_3" sourceRef="decide" targetRef="review"/>
+    <bpmn:userTask id="review" name="Review">
+      <bpmn:extensionElements>
+        <zeebe:formDefinition formKey="camunda-forms:bpmn:userTaskForm_{n}"/>
+      </bpmn:extensionElements>
+    </bpmn:userTask>
+    <bpmn:sequenceFlow id="flow_4" sourceRef="review" targetRef="end"/>
+    <bpmn:endEvent id="end" name="End"/>
+  </bpmn:process>
+</bpmn:definitions>
+"""
+
+DMN = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="https://www.omg.org/spec/DMN/20191111/MODEL/" id="requirements" name="Benchmark decisions" namespace="http://camunda.org/schema/1.0/dmn">
+  <decision id="decision" name="Benchmark decision">
+    <decisionTable id="table">
+      <input id="input"><inputExpression typeRef="number"><text>amount</text></inputExpression></input>
+      <output id="output" name="approved" typeRef="boolean"/>
+      <rule id="rule"><inputEntry><text>&lt; 1000</text></inputEntry><outputEntry><text>true</text></outputEntry></rule>
+    </decisionTable>
+  </decision>
+</definitions>
+"""
+
+FORM = json.dumps(
+    {
+        "components": [
+            {"key": "approved", "label": "Approved", "type": "checkbox"},
+            {"key": "comment", "label": "Comment", "type": "textarea"},
+        ],
+        "type": "default",
+    }
+)
+
+
+class Generator:
+    """Synthetic Zeebe record streams as exported by the Zeebe Redis exporter.
+
+    Yields (stream name, record) tuples in export order: process and decision
+    deployments first, then the PROCESS_INSTANCE, JOB, VARIABLE, INCIDENT and
+    DECISION_EVALUATION records of ``instances`` process instances, of which
+    ``concurrency`` run interleaved at any time. A ``running_ratio`` share of
+    the instances is left running, waiting at its user task or, with
+    ``incident_ratio``, at an unresolved incident of its service task.
+    """
+
+    def __init__(
+        self,
+        instances=1000,
+        processes=10,
+        partitions=3,
+        concurrency=50,
+        payload_size=256,
+        incident_ratio=0.05,
+        command_ratio=0.5,
+        running_ratio=0.0,
+        seed=0,
+    ):
+        self.instances = instances
+        self.processes = processes
+        self.partitions = partitions
+        self.concurrency = concurrency
+        self.payload_size = payload_size
+        self.incident_ratio = incident_ratio
+        self.command_ratio = command_ratio
+        self.running_ratio = running_ratio
+        self.random = random.Random(seed)
+        self.timestamp = 1680000000000
+        self.counters = {}
+        self.position = 0
+
+    def key(self, partition):
+        self.counters[partition] = self.counters.get(partition, 0) + 1
+        return (partition << PARTITION_BITS) + self.counters[partition]
+
+    def record(self, value_type, intent, key, value, partition, record_type="EVENT"):
+        self.timestamp += self.random.randint(0, 3)
+        self.position += 1
+        return (
+            f"zeebe:{value_type}",
+            {
+                "partitionId": partition,
+                "value": value,
+                "key": key,
+                "timestamp": self.timestamp,
+                "recordType": record_type,
+                "valueType": value_type,
+                "intent": intent,
+                "rejectionType": "NULL_VAL",
+                "rejectionReason": "",
+                "brokerVersion": "8.2.0",
+                "sourceRecordPosition": self.position - 1,
+                "position": self.position,
+            },
+        )
+
+    def payload(self):
+        return {
+            "amount": self.random.randint(0, 2000),
+            "document": "x" * self.payload_size,
+        }
+
+    def __iter__(self):
+        definitions = list(itertools.chain.from_iterable(self.deploy()))
+        yield from definitions
+        processes = [
+            (record["value"]["bpmnProcessId"], record["key"])
+            for stream, record in definitions
+            if stream == "zeebe:PROCESS"
+        ]
+        decision = next(
+            record for stream, record in definitions if stream == "zeebe:DECISION"
+        )
+        running = []
+        started = 0
+        while started < self.instances or running:
+            while started < self.instances and len(running) < self.concurrency:
+                process = processes[started % len(processes)]
+                running.append(self.process_instance(process, decision))
+                started += 1
+            instance = self.random.choice(running)
+            try:
+                yield from next(instance)
+            except StopIteration:
+                running.remove(instance)
+
+    def deploy(self):
+        for n in range(self.processes):
+            key = self.key(1)
+            process_id = f"benchmark-process-{n}"
+            resource = BPMN.format(
+                n=n, process_id=process_id, form=FORM.replace('"', "&quot;")
+            )
+            yield [
+                self.record(
+                    "PROCESS",
+                    "CREATED",
+                    key,
+                    {
+                        "bpmnProcessId": process_id,
+                        "version": 1,
+                        "processDefinitionKey": key,
+                        "resourceName": f"{process_id}.bpmn",
+                        "checksum": "",
+                        "resource": base64.b64encode(resource.encode()).decode(),
+                    },
+                    1,
+                )
+            ]
+        requirements_key = self.key(1)
+        yield [
+            self.record(
+                "DECISION_REQUIREMENTS",
+                "CREATED",
+                requirements_key,
+                {
+                    "decisionRequirementsId": "requirements",
+                    "decisionRequirementsName": "Benchmark decisions",
+                    "decisionRequirementsVersion": 1,
+                    "decisionRequirementsKey": requirements_key,
+                    "namespace": "http://camunda.org/schema/1.0/dmn",
+                    "resourceName": "benchmark.dmn",
+                    "checksum": "",
+                    "resource": base64.b64encode(DMN.encode()).decode(),
+                },
+                1,
+            )
+        ]
+        decision_key = self.key(1)
+        yield [
+            self.record(
+                "DECISION",
+                "CREATED",
+                decision_key,
+                {
+                    "decisionId": "decision",
+                    "decisionName": "Benchmark decision",
+                    "version": 1,
+                    "decisionKey": decision_key,
+                    "decisionRequirementsId": "requirements",
+                    "decisionRequirementsKey": requirements_key,
+                },
+                1,
+            )
+        ]
+
+    def process_instance(self, process, decision):
+        """Yields the records of one process instance in steps."""
+        bpmn_process_id, process_definition_key = process
+        partition = self.random.randint(1, self.partitions)
+        instance_key = self.key(partition)
+        # The element a running instance stops at.
+        waiting = None
+        if self.running_ratio and self.random.random() < self.running_ratio:
+            if self.random.random() < self.incident_ratio:
+                waiting = "service"
+            else:
+                waiting = "review"
+
+        def element(key, element_id, element_type, intent, flow_scope_key):
+            return self.record(
+                "PROCESS_INSTANCE",
+                intent,
+                key,
+                {
+                    "bpmnProcessId": bpmn_process_id,
+                    "version": 1,
+                    "processDefinitionKey": process_definition_key,
+                    "processInstanceKey": instance_key,
+                    "elementId": element_id,
+                    "flowScopeKey": flow_scope_key,
+                    "bpmnElementType": element_type,
+                    "bpmnEventType": "UNSPECIFIED",
+                    "parentProcessInstanceKey": -1,
+                    "parentElementInstanceKey": -1,
+                },
+                partition,
+            )
+
+        def lifecycle(key, element_id, element_type, intents):
+            return [
+                element(key, element_id, element_type, intent, instance_key)
+                for intent in intents
+            ]
+
+        def command(value_type, intent, key, value):
+            if self.random.random() < self.command_ratio:
+                return [
+                    self.record(value_type, intent, key, value, partition, "COMMAND")
+                ]
+            return []
+
+        def flow(flow_id):
+            return [
+                element(
+                    self.key(partition),
+                    flow_id,
+                    "SEQUENCE_FLOW",
+                    "SEQUENCE_FLOW_TAKEN",
+                    instance_key,
+                )
+            ]
+
+        def variable(intent, name, value, scope_key):
+            return self.record(
+                "VARIABLE",
+                intent,
+                self.key(partition),
+                {
+                    "name": name,
+                    "value": json.dumps(value),
+                    "scopeKey": scope_key,
+                    "processInstanceKey": instance_key,
+                    "processDefinitionKey": process_definition_key,
+                    "bpmnProcessId": bpmn_process_id,
+                },
+                partition,
+            )
+
+        def job(intent, key, element_id, element_instance_key, job_type, headers):
+            return self.record(
+                "JOB",
+                intent,
+                key,
+                {
+                    "type": job_type,
+                    "customHeaders": headers,
+                    "worker": intent == "CREATED" and "" or "benchmark-worker",
+                    "retries": 3,
+                    "retryBackoff": 0,
+                    "recurringTime": -1,
+                    "deadline": intent == "CREATED" and -1 or self.timestamp + 300000,
+                    "errorMessage": "",
+                    "errorCode": "",
+                    "variables": intent == "COMPLETED" and self.payload() or {},
+                    "processInstanceKey": instance_key,
+                    "bpmnProcessId": bpmn_process_id,
+                    "processDefinitionVersion": 1,
+                    "processDefinitionKey": process_definition_key,
+                    "elementId": element_id,
+                    "elementInstanceKey": element_instance_key,
+                },
+                partition,
+            )
+
+        def task(element_id, element_type, job_type, headers):
+            waiting_here = waiting == element_id
+            key = self.key(partition)
+            job_key = self.key(partition)
+            yield lifecycle(
+                key,
+                element_id,
+                element_type,
+                ["ELEMENT_ACTIVATING", "ELEMENT_ACTIVATED"],
+            ) + [job("CREATED", job_key, element_id, key, job_type, headers)]
+            if waiting_here and element_type == "USER_TASK":
+                return
+            if waiting_here or self.random.random() < self.incident_ratio:
+                incident_key = self.key(partition)
+                incident = {
+                    "errorType": "JOB_NO_RETRIES",
+                    "errorMessage": "Benchmark failure",
+                    "bpmnProcessId": bpmn_process_id,
+                    "processDefinitionKey": process_definition_key,
+                    "processInstanceKey": instance_key,
+                    "elementId": element_id,
+                    "elementInstanceKey": key,
+                    "jobKey": job_key,
+                    "variableScopeKey": key,
+                }
+                yield [
+                    self.record(
+                        "INCIDENT", "CREATED", incident_key, incident, partition
+                    )
+                ]
+                if waiting_here:
+                    return
+                yield [
+                    self.record(
+                        "INCIDENT", "RESOLVED", incident_key, incident, partition
+                    )
+                ]
+            yield command("JOB", "COMPLETE", job_key, {}) + [
+                job("COMPLETED", job_key, element_id, key, job_type, headers),
+                variable(
+                    "CREATED", f"{element_id}Result", self.payload(), instance_key
+                ),
+            ] + lifecycle(
+                key,
+                element_id,
+                element_type,
+                ["ELEMENT_COMPLETING", "ELEMENT_COMPLETED"],
+            )
+
+        yield command(
+            "PROCESS_INSTANCE_CREATION",
+            "CREATE",
+            -1,
+            {"bpmnProcessId": bpmn_process_id},
+        ) + [
+            element(instance_key, bpmn_process_id, "PROCESS", "ELEMENT_ACTIVATING", -1),
+            element(instance_key, bpmn_process_id, "PROCESS", "ELEMENT_ACTIVATED", -1),
+            variable("CREATED", "request", self.payload(), instance_key),
+        ] + lifecycle(
+            self.key(partition),
+            "start",
+            "START_EVENT",
+            [
+                "ELEMENT_ACTIVATING",
+                "ELEMENT_ACTIVATED",
+                "ELEMENT_COMPLETING",
+                "ELEMENT_COMPLETED",
+            ],
+        ) + flow(
+            "flow_1"
+        )
+        yield from task("service", "SERVICE_TASK", "benchmark-service", {})
+        if waiting == "service":
+            return
+        yield flow("flow_2")
+        key = self.key(partition)
+        yield lifecycle(
+            key,
+            "decide",
+            "BUSINESS_RULE_TASK",
+            ["ELEMENT_ACTIVATING", "ELEMENT_ACTIVATED"],
+        ) + [
+            self.record(
+                "DECISION_EVALUATION",
+                "EVALUATED",
+                self.key(partition),
+                {
+                    "decisionKey": decision["key"],
+                    "decisionId": "decision",
+                    "decisionName": "Benchmark decision",
+                    "decisionVersion": 1,
+                    "decisionRequirementsId": "requirements",
+                    "decisionRequirementsKey": decision["value"][
+                        "decisionRequirementsKey"
+                    ],
+                    "decisionOutput": "true",
+                    "bpmnProcessId": bpmn_process_id,
+                    "processDefinitionKey": process_definition_key,
+                    "processInstanceKey": instance_key,
+                    "elementId": "decide",
+                    "elementInstanceKey": key,
+                    "evaluatedDecisions": [
+                        {
+                            "decisionId": "decision",
+                            "decisionName": "Benchmark decision",
+                            "decisionKey": decision["key"],
+                            "decisionOutput": "true",
+                            "evaluatedInputs": [],
+                            "matchedRules": [],
+                        }
+                    ],
+                    "evaluationFailureMessage": "",
+                    "failedDecisionId": "",
+                },
+                partition,
+            ),
+            variable("CREATED", "result", True, instance_key),
+        ] + lifecycle(
+            key,
+            "decide",
+            "BUSINESS_RULE_TASK",
+            ["ELEMENT_COMPLETING", "ELEMENT_COMPLETED"],
+        )
+        yield flow("flow_3")
+        yield from task(
+            "review",
+            "USER_TASK",
+            "io.camunda.zeebe:userTask",
+            {
+                "io.camunda.zeebe:formKey": (
+                    f"camunda-forms:bpmn:userTaskForm_"
+                    f"{bpmn_process_id.rsplit('-', 1)[-1]}"
+                )
+            },
+        )
+        if waiting == "review":
+            return
+        yield flow("flow_4") + lifecycle(
+            self.key(partition),
+            "end",
+            "END_EVENT",
+            [
+                "ELEMENT_ACTIVATING",
+                "ELEMENT_ACTIVATED",
+                "ELEMENT_COMPLETING",
+                "ELEMENT_COMPLETED",
+            ],
+        ) + [
+            element(instance_key, bpmn_process_id, "PROCESS", "ELEMENT_COMPLETING", -1),
+            element(instance_key, bpmn_process_id, "PROCESS", "ELEMENT_COMPLETED", -1),
+        ]
+
+
+def stream_entries(records):
+    """Assigns Redis stream entry IDs to (stream, record) tuples."""
+    last = {}
+    for stream, record in records:
+        ms, seq = last.get(stream, (0, -1))
+        if record["timestamp"] > ms:
+            ms, seq = record["timestamp"], 0
+        else:
+            seq += 1
+        last[stream] = ms, seq
+        yield stream, f"{ms}-{seq}", record
+
+
+def parse_id(id_):
+    if isinstance(id_, bytes):
+        id_ = id_.decode("utf-8")
+    ms, _, seq = str(id_).partition("-")
+    return int(ms), int(seq or 0)
+
+
+class FakeRedis:
+    """In-process stand-in for the Redis commands used by the importer."""
+
+    def __init__(self):
+        self.streams = {}
+
+    def xadd(self, name, fields, id="*"):
+        if isinstance(name, str):
+            name = name.encode("utf-8")
+        entries = self.streams.setdefault(name, ([], []))
+        if isinstance(id, str):
+            id = id.encode("utf-8")
+        entries[0].append(parse_id(id))
+        entries[1].append(
+            (
+                id,
+                {
+                    (k.encode("utf-8") if isinstance(k, str) else k): (
+                        v.encode("utf-8") if isinstance(v, str) else v
+                    )
+                    for k, v in fields.items()
+                },
+            )
+        )
+        return id
+
+    def xread(self, streams, count=None, block=None):
+        result = []
+        for name, id_ in streams.items():
+            ids, entries = self.streams.get(name, ([], []))
+            start = bisect.bisect_right(ids, parse_id(id_))
+            stop = len(ids) if count is None else start + count
+            if entries[start:stop]:
+                result.append([name, entries[start:stop]])
+        return result
+
+    def last_ids(self):
+        return {name: entries[-1][0] for name, (_, entries) in self.streams.items()}
+
+    def publish(self, channel, message):
+        return 0
+
+    def close(self):
+        pass
+
+
+def load(r, entries):
+    for stream, id_, record in entries:
+        r.xadd(stream, {"record": json.dumps(record)}, id=id_)
@@ -1,14 +1,38 @@
+import asyncio
 import base64
+import bisect
+import contextlib
+import hashlib
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import random
+import re
+import shutil
+import threading
 import time
-from functools import lru_cache
+import zlib
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Optional
 
 import apsw
+import click
 import redis
+import redis.asyncio
 from lxml import etree
 
+import watermark
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logging.basicConfig(level=logging.DEBUG)
 
 namespaces = {
@@ -18,15 +42,147 @@ namespaces = {
 }
 
 
+Definition = namedtuple("Definition", ["process_name", "element_names", "forms"])
+
+# The fields of an exported Zeebe EVENT record that the importer reads.
+Event = namedtuple("Event", ["key", "intent", "timestamp", "value"])
+
+# Every EVENT record contains this, as the value of its recordType.
+EVENT_MARKER = b'"EVENT"'
+
+
+def loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def event_from_record(record):
+    if record.get("recordType") != "EVENT":
+        return None
+    return Event(record["key"], record["intent"], record["timestamp"], record["value"])
+
+
+def decode_event(data):
+    # COMMAND and COMMAND_REJECTION records are mostly skipped unparsed.
+    if EVENT_MARKER not in data:
+        return None
+    return event_from_record(loads(data))
+
+
+class DefinitionCache:
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, connection, process_definition_key):
+        try:
+            definition = self.entries[process_definition_key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(process_definition_key)
+            return definition
+        definition = load_definition(connection, process_definition_key)
+        if definition is not None:
+            self.entries[process_definition_key] = definition
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return definition
+
+    def invalidate(self, process_definition_key):
+        self.entries.pop(process_definition_key, None)
+
+
+DEFINITIONS = DefinitionCache()
+
+
 def get_bpmn(connection, process_definition_key):
-    @lru_cache(maxsize=128)
-    def get_bpmn_etree(key):
-        cursor = connection.cursor()
-        query = cursor.execute("SELECT resource FROM process WHERE key=?", (key,))
-        for result in filter(bool, query.fetchone() or []):
-            return etree.fromstring(base64.b64decode(result))
+    cursor = connection.cursor()
+    query = cursor.execute(
+        "SELECT data FROM resource"
+        " WHERE hash = (SELECT resource FROM process WHERE key=?)",
+        (process_definition_key,),
+    )
+    for result in filter(bool, query.fetchone() or []):
+        return etree.fromstring(zlib.decompress(result))
+
+
+def load_definition(connection, process_definition_key):
+    bpmn = get_bpmn(connection, process_definition_key)
+    if bpmn is None:
+        return None
+    process_name = None
+    for el in bpmn.iterfind(".//bpmn:process", namespaces=namespaces):
+        process_name = el.attrib.get("name")
+    return Definition(
+        process_name,
+        {
+            el.attrib["id"]: el.attrib["name"]
+            for el in bpmn.iterfind(".//*[@id][@name]")
+        },
+        [
+            (el.attrib["id"], el.text)
+            for el in bpmn.iterfind(".//zeebe:userTaskForm", namespaces=namespaces)
+        ],
+    )
+
+
+# Deployed BPMN and DMN resources are stored once, zlib compressed, keyed by
+# the SHA-256 of their content, which process and decision_requirements keep
+# in their resource column.
+RESOURCE_INSERT = """\
+INSERT OR IGNORE INTO resource VALUES (?, ?)
+"""
+
 
-    return get_bpmn_etree(process_definition_key)
+def resource_row(resource):
+    data = base64.b64decode(resource)
+    digest = hashlib.sha256(data).hexdigest()
+    return digest, (RESOURCE_INSERT, (digest, zlib.compress(data)))
+
+
+def inflate_base64(data):
+    # The base64 of a stored resource, as exported by Zeebe.
+    return data and base64.b64encode(zlib.decompress(data)).decode("ascii")
+
+
+# Variable values and job variables longer than PAYLOAD_THRESHOLD are stored
+# once, zlib compressed, in the payload table keyed by their SHA-256. The row
+# keeps a JSON reference with a preview, which the variable_full and job_full
+# views replace with the value.
+PAYLOAD_THRESHOLD = 64 * 1024
+PAYLOAD_PREVIEW = 256
+
+PAYLOAD_INSERT = """\
+INSERT OR IGNORE INTO payload VALUES (?, ?)
+"""
+
+
+def set_payload_threshold(threshold):
+    global PAYLOAD_THRESHOLD
+    PAYLOAD_THRESHOLD = threshold
+
+
+def spill(value, rows):
+    if not PAYLOAD_THRESHOLD or value is None or len(value) <= PAYLOAD_THRESHOLD:
+        return value
+    data = value.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    rows.append((PAYLOAD_INSERT, (digest, zlib.compress(data))))
+    return json.dumps(
+        {"$payload": digest, "size": len(data), "preview": value[:PAYLOAD_PREVIEW]}
+    )
+
+
+def inflate_text(data):
+    return data and zlib.decompress(data).decode("utf-8")
+
+
+def duration_bucket(duration):
+    # Durations of bucket b are below 2**b milliseconds.
+    return max(int(duration), 0).bit_length()
 
 
 def maybe_str(x: int) -> Optional[str]:
@@ -35,10 +191,19 @@ def maybe_str(x: int) -> Optional[str]:
     return str(x)
 
 
-def init_db(connection):
+def init_db(connection, indexes=True, triggers=True):
     cursor = connection.cursor()
     cursor.execute(
         """\
+create table if not exists resource(
+    hash TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (hash)
+)
+"""
+    )
+    cursor.execute(
+        """\
 create table if not exists process(
     key TEXT NOT NULL UNIQUE,
     bpmnProcessId TEXT NOT NULL,
@@ -224,405 +389,2801 @@ create table if not exists incident(
 )
 """
     )
-
-
-def handle_process(connection, event):
-    cursor = connection.cursor()
     cursor.execute(
-        f"""\
-INSERT INTO process VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET version=?, resourceName=?, resource=?, state=?, updated=?
-WHERE updated <= excluded.updated
-""",
-        (
-            str(event["key"]),
-            event["value"]["bpmnProcessId"],
-            "",
-            event["value"]["version"],
-            event["value"]["resourceName"],
-            event["value"]["resource"],
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            # ON CONFLICT
-            event["value"]["version"],
-            event["value"]["resourceName"],
-            event["value"]["resource"],
-            event["intent"],
-            str(event["timestamp"]),
-        ),
+        """\
+create table if not exists message(
+    key TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    correlationKey TEXT NOT NULL,
+    messageId TEXT,
+    timeToLive INTEGER NOT NULL,
+    deadline INTEGER,
+    variables TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    completed TEXT,
+    PRIMARY KEY (key)
+)
+"""
     )
-    bpmn = get_bpmn(connection, str(event["value"]["processDefinitionKey"]))
-    for el in bpmn.xpath("//bpmn:process", namespaces=namespaces) if bpmn else []:
-        process_name = el.attrib.get("name")
-        cursor.execute(
-            "UPDATE process SET bpmnProcessName=? WHERE key=?",
-            (
-                process_name,
-                str(event["value"]["processDefinitionKey"]),
-            ),
+    cursor.execute(
+        """\
+create table if not exists timer(
+    key TEXT NOT NULL UNIQUE,
+    processInstance TEXT,
+    processDefinition TEXT NOT NULL,
+    elementInstance TEXT,
+    targetElementId TEXT NOT NULL,
+    dueDate INTEGER NOT NULL,
+    repetitions INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    completed TEXT,
+    PRIMARY KEY (key),
+    FOREIGN KEY (processInstance) REFERENCES process_instance(key),
+    FOREIGN KEY (processDefinition) REFERENCES process(key),
+    FOREIGN KEY (elementInstance) REFERENCES element_instance(key)
+)
+"""
+    )
+    cursor.execute(
+        """\
+create table if not exists user_task(
+    key TEXT NOT NULL UNIQUE,
+    processInstance TEXT NOT NULL,
+    processDefinition TEXT NOT NULL,
+    elementInstance TEXT NOT NULL,
+    elementId TEXT NOT NULL,
+    assignee TEXT,
+    candidateGroups TEXT NOT NULL,
+    candidateUsers TEXT NOT NULL,
+    dueDate TEXT,
+    followUpDate TEXT,
+    formKey TEXT,
+    variables TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    completed TEXT,
+    PRIMARY KEY (key),
+    FOREIGN KEY (processInstance) REFERENCES process_instance(key),
+    FOREIGN KEY (processDefinition) REFERENCES process(key),
+    FOREIGN KEY (elementInstance) REFERENCES element_instance(key)
+)
+"""
+    )
+    cursor.execute(
+        """\
+create table if not exists process_message_subscription(
+    elementInstance TEXT NOT NULL,
+    messageName TEXT NOT NULL,
+    processInstance TEXT NOT NULL,
+    elementId TEXT NOT NULL,
+    correlationKey TEXT NOT NULL,
+    messageKey TEXT,
+    interrupting INTEGER NOT NULL,
+    variables TEXT NOT NULL,
+    state TEXT NOT NULL,
+    created TEXT NOT NULL,
+    updated TEXT NOT NULL,
+    completed TEXT,
+    PRIMARY KEY (elementInstance, messageName),
+    FOREIGN KEY (processInstance) REFERENCES process_instance(key),
+    FOREIGN KEY (elementInstance) REFERENCES element_instance(key),
+    FOREIGN KEY (messageKey) REFERENCES message(key)
+)
+"""
+    )
+    cursor.execute(
+        """\
+create table if not exists checkpoint(
+    stream TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (stream)
+)
+"""
+    )
+    cursor.execute(
+        """\
+create table if not exists payload(
+    hash TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (hash)
+)
+"""
+    )
+    for table, column in (
+        ("variable", "value"),
+        ("job", "variables"),
+        ("message", "variables"),
+        ("user_task", "variables"),
+        ("process_message_subscription", "variables"),
+    ):
+        columns = ", ".join(
+            name == column
+            and f"coalesce(inflate_text(p.data), t.{name}) as {name}"
+            or f"t.{name}"
+            for name in table_columns(connection, table)
         )
-    for el in bpmn.xpath("//zeebe:userTaskForm", namespaces=namespaces) if bpmn else []:
         cursor.execute(
             f"""\
-INSERT INTO form VALUES (?, ?, ?)
-ON CONFLICT DO UPDATE SET schema=?
-""",
-            (
-                el.attrib["id"],
-                str(event["value"]["processDefinitionKey"]),
-                el.text,
-                # ON CONFLICT
-                el.text,
-            ),
+create view if not exists {table}_full as
+select {columns} from {table} t
+left join payload p on t.{column} like '{{"$payload":%'
+and p.hash = json_extract(t.{column}, '$."$payload"')
+"""
         )
+    cursor.execute(
+        """\
+create view if not exists resource_base64 as
+select hash, inflate_base64(data) as resource from resource
+"""
+    )
+    store_resources(connection)
+    if schema_version(connection) == 2:
+        # Tables added since the migration.
+        migrate_schema(connection, triggers=triggers)
+    if indexes:
+        init_indexes(connection)
+    if triggers:
+        init_counters(connection)
+        init_durations(connection)
+        init_search(connection)
 
 
-def handle_process_instance(connection, event):
+def store_resources(connection):
+    # Moves the base64 resources of databases created before the resource
+    # table into it.
     cursor = connection.cursor()
-    if event["value"]["elementId"] == event["value"]["bpmnProcessId"]:
-        cursor.execute(
-            f"""\
-INSERT INTO process_instance VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET state=?, updated=?, completed=?
-WHERE updated <= excluded.updated
+    with connection:
+        for table in ("process", "decision_requirements"):
+            for key, resource in cursor.execute(
+                f"SELECT key, resource FROM {table}"
+                " WHERE resource NOT IN (SELECT hash FROM resource)"
+            ).fetchall():
+                digest, row = resource_row(resource)
+                execute_rows(connection, [row])
+                cursor.execute(
+                    f"UPDATE {table} SET resource=? WHERE key=?", (digest, key)
+                )
+
+
+INDEXES = {
+    # Running process instances in key order (GraphQL lists, first: N).
+    "process_instance_open_key": """\
+create index if not exists process_instance_open_key
+on process_instance(key) where completed is null
 """,
-            (
-                str(event["key"]),
-                str(event["value"]["processDefinitionKey"]),
-                maybe_str(event["value"]["parentProcessInstanceKey"]),
-                maybe_str(event["value"]["parentElementInstanceKey"]),
-                event["intent"],
-                str(event["timestamp"]),
-                str(event["timestamp"]),
-                event["intent"] == "ELEMENT_COMPLETED"
-                and str(event["timestamp"])
-                or None,
-                # ON CONFLICT
-                event["intent"],
-                str(event["timestamp"]),
-                event["intent"] == "ELEMENT_COMPLETED"
-                and str(event["timestamp"])
-                or None,
-            ),
-        )
-    if event["value"]["bpmnElementType"] not in ["SEQUENCE_FLOW", "PROCESS"]:
-        cursor.execute(
-            f"""\
-INSERT INTO element_instance VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET flowScopeKey=?, state=?, updated=?, completed=?
-WHERE updated <= excluded.updated
+    # Completed process instances by age (retention).
+    "process_instance_completed": """\
+create index if not exists process_instance_completed
+on process_instance(completed) where completed is not null
 """,
-            (
-                str(event["key"]),
-                str(event["value"]["processInstanceKey"]),
-                event["value"]["elementId"],
-                "",
-                event["value"]["bpmnElementType"],
-                maybe_str(event["value"]["flowScopeKey"]) or str(event["key"]),
-                event["intent"],
-                str(event["timestamp"]),
-                str(event["timestamp"]),
-                event["intent"] in ["ELEMENT_COMPLETED", "SEQUENCE_FLOW_TAKEN"]
-                and str(event["timestamp"])
-                or None,
-                # ON CONFLICT
-                maybe_str(event["value"]["flowScopeKey"]) or str(event["key"]),
-                event["intent"],
-                str(event["timestamp"]),
-                event["intent"] in ["ELEMENT_COMPLETED", "SEQUENCE_FLOW_TAKEN"]
-                and str(event["timestamp"])
-                or None,
-            ),
-        )
-    bpmn = get_bpmn(connection, str(event["value"]["processDefinitionKey"]))
-    element_id = event["value"]["elementId"]
-    for el in bpmn.xpath(f'//*[@id="{element_id}"]') if bpmn else []:
-        element_name = el.attrib.get("name")
-        if element_name:
-            cursor.execute(
-                "UPDATE element_instance SET elementName =? WHERE key=?",
-                (
-                    element_name,
-                    str(event["key"]),
-                ),
-            )
+    # Element instances of a process instance, filtered by type and state.
+    "element_instance_process_instance": """\
+create index if not exists element_instance_process_instance
+on element_instance(processInstance, bpmnElementType, completed)
+""",
+    # Open jobs by type (human task list and counters).
+    "job_open": """\
+create index if not exists job_open
+on job(type) where completed is null
+""",
+    "job_open_key": """\
+create index if not exists job_open_key
+on job(key) where completed is null
+""",
+    "job_process_instance": """\
+create index if not exists job_process_instance
+on job(processInstance)
+""",
+    "job_element_instance": """\
+create index if not exists job_element_instance
+on job(elementInstance)
+""",
+    # Open incidents, and incidents of a process instance.
+    "incident_open": """\
+create index if not exists incident_open
+on incident(processDefinition) where completed is null
+""",
+    "incident_process_instance": """\
+create index if not exists incident_process_instance
+on incident(processInstance)
+""",
+    "variable_process_instance": """\
+create index if not exists variable_process_instance
+on variable(processInstance)
+""",
+    "decision_evaluation_process_instance": """\
+create index if not exists decision_evaluation_process_instance
+on decision_evaluation(processInstance)
+""",
+    "timer_process_instance": """\
+create index if not exists timer_process_instance
+on timer(processInstance)
+""",
+    "user_task_process_instance": """\
+create index if not exists user_task_process_instance
+on user_task(processInstance)
+""",
+    "process_message_subscription_process_instance": """\
+create index if not exists process_message_subscription_process_instance
+on process_message_subscription(processInstance)
+""",
+}
 
 
-def handle_job(connection, event):
-    cursor = connection.cursor()
-    form = (
-        event["value"]["customHeaders"].get("io.camunda.zeebe:formKey") or ""
-    ).rsplit(":", 1)[-1] or None
-    cursor.execute(
-        f"""\
-INSERT INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET variables=?, worker=?, errorCode=?, errorMessage=?, state=?, retryBackoff=?, recurringTime=?, retries=?, deadline=?, updated=?, completed=?
-WHERE updated <= excluded.updated
-""",
-        (
-            str(event["key"]),
-            event["value"]["type"],
-            str(event["value"]["processInstanceKey"]),
-            str(event["value"]["processDefinitionKey"]),
-            str(event["value"]["elementInstanceKey"]),
-            json.dumps(event["value"]["customHeaders"]),
-            json.dumps(event["value"]["variables"]),
-            form,
-            event["value"]["worker"],
-            event["value"]["errorCode"],
-            event["value"]["errorMessage"],
-            event["intent"],
-            event["value"]["retryBackoff"],
-            event["value"]["recurringTime"],
-            event["value"]["retries"],
-            event["value"]["deadline"],
-            event["timestamp"],
-            event["timestamp"],
-            event["intent"] == "COMPLETED" and event["timestamp"] or None,
-            # ON CONFLICT
-            json.dumps(event["value"]["variables"]),
-            event["value"]["worker"],
-            event["value"]["errorCode"],
-            event["value"]["errorMessage"],
-            event["intent"],
-            event["value"]["retryBackoff"],
-            event["value"]["recurringTime"],
-            event["value"]["retries"],
-            event["value"]["deadline"],
-            event["timestamp"],
-            event["intent"] == "COMPLETED" and event["timestamp"] or None,
-        ),
-    )
+# Indexes of earlier versions that no query reads any more.
+DROPPED_INDEXES = [
+    # Replaced by the running_process_instances counter.
+    "process_instance_open",
+]
 
 
-def handle_decision_requirements(connection, event):
+def init_indexes(connection):
     cursor = connection.cursor()
-    cursor.execute(
-        f"""\
-INSERT INTO decision_requirements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET decisionRequirementsId=?, decisionRequirementsName=?, version=?, resource=?, resourceName=?, state=?, updated=?
-WHERE updated <= excluded.updated
-""",
-        (
-            str(event["key"]),
-            event["value"]["decisionRequirementsId"],
-            event["value"]["decisionRequirementsName"],
-            event["value"]["decisionRequirementsVersion"],
-            event["value"]["resource"],
-            event["value"]["resourceName"],
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            # ON CONFLICT
-            event["value"]["decisionRequirementsId"],
-            event["value"]["decisionRequirementsName"],
-            event["value"]["decisionRequirementsVersion"],
-            event["value"]["resource"],
-            event["value"]["resourceName"],
-            event["intent"],
-            str(event["timestamp"]),
-        ),
-    )
+    for name in DROPPED_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    for statement in INDEXES.values():
+        cursor.execute(statement)
+
+
+# Dashboard counters of open rows by key, maintained by triggers in the
+# transaction of the change.
+COUNTERS = {
+    "running_process_instances": ("process_instance", "processDefinition"),
+    "open_jobs": ("job", "type"),
+    "open_incidents": ("incident", "processDefinition"),
+}
+
+COUNTER_ADD = """\
+insert into counter(name, key, value) select '{name}', {row}.{column}, {value}
+where {row}.completed is null
+on conflict (name, key) do update set value = value + excluded.value;"""
+
+COUNTER_TRIGGERS = """\
+create trigger if not exists {name}_insert after insert on {table} begin
+{insert}
+end;
+create trigger if not exists {name}_update after update of completed on {table} begin
+{delete}
+{insert}
+end;
+create trigger if not exists {name}_delete after delete on {table} begin
+{delete}
+end;
+"""
 
 
-def handle_decision(connection, event):
+def init_counters(connection):
     cursor = connection.cursor()
     cursor.execute(
-        f"""\
-INSERT INTO decision VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET decisionId=?, decisionName=?, decisionRequirements=?, version=?, state=?, updated=?
-WHERE updated <= excluded.updated
-""",
-        (
-            str(event["key"]),
-            event["value"]["decisionId"],
-            event["value"]["decisionName"],
-            event["value"]["decisionRequirementsKey"],
-            event["value"]["version"],
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            # ON CONFLICT
-            event["value"]["decisionId"],
-            event["value"]["decisionName"],
-            event["value"]["decisionRequirementsKey"],
-            event["value"]["version"],
-            event["intent"],
-            str(event["timestamp"]),
-        ),
+        """\
+create table if not exists counter(
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+)
+"""
     )
+    for name, (table, column) in COUNTERS.items():
+        cursor.execute(
+            COUNTER_TRIGGERS.format(
+                name=name,
+                table=table,
+                insert=COUNTER_ADD.format(name=name, row="new", column=column, value=1),
+                delete=COUNTER_ADD.format(
+                    name=name, row="old", column=column, value=-1
+                ),
+            )
+        )
 
 
-def handle_decision_evaluation(connection, event):
+def rebuild_counters(connection):
     cursor = connection.cursor()
-    cursor.execute(
-        f"""\
-INSERT INTO decision_evaluation VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET decisionOutput=?, evaluatedDecisions=?, state=?, updated=?, completed=?
-WHERE updated <= excluded.updated
-""",
-        (
-            str(event["key"]),
-            str(event["value"]["processInstanceKey"]),
-            str(event["value"]["processDefinitionKey"]),
-            str(event["value"]["elementInstanceKey"]),
-            event["value"]["decisionRequirementsKey"],
-            event["value"]["decisionKey"],
-            json.dumps(event["value"]["decisionOutput"]),
-            json.dumps(event["value"]["evaluatedDecisions"]),
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            event["intent"] == "EVALUATED" and event["timestamp"] or None,
-            # ON CONFLICT
-            json.dumps(event["value"]["decisionOutput"]),
-            json.dumps(event["value"]["evaluatedDecisions"]),
-            event["intent"],
-            str(event["timestamp"]),
-            event["intent"] == "EVALUATED" and event["timestamp"] or None,
-        ),
-    )
+    with connection:
+        cursor.execute("DELETE FROM counter")
+        for name, (table, column) in COUNTERS.items():
+            cursor.execute(
+                f"INSERT INTO counter(name, key, value)"
+                f" SELECT '{name}', {column}, count(*) FROM {table}"
+                f" WHERE completed IS NULL GROUP BY {column}"
+            )
+
+
+# Duration statistics of completed rows (count, sum, min, max and a log2
+# histogram in milliseconds), maintained by triggers when a row completes:
+# element instances per process definition and element, jobs per type and
+# incidents (until resolved) per process definition and element.
+DURATIONS = {
+    "element": (
+        "element_instance",
+        "(select processDefinition from process_instance"
+        " where key = {row}.processInstance)",
+        "{row}.elementId",
+        "{row}.state = 'ELEMENT_COMPLETED'",
+    ),
+    "job": ("job", "{row}.type", "''", "1"),
+    "incident": ("incident", "{row}.processDefinition", "{row}.elementId", "1"),
+}
 
+DURATION_ADD = """\
+insert into duration(name, key, elementId, bucket, count, sum, min, max)
+select '{name}', key, elementId, duration_bucket(duration), 1, duration, duration,
+duration from (
+    select {key} as key, {element} as elementId,
+    new.completed - new.created as duration
+) where key is not null
+on conflict (name, key, elementId, bucket) do update set count = count + 1,
+sum = sum + excluded.sum, min = min(min, excluded.min), max = max(max, excluded.max);"""
 
-def handle_variable(connection, event):
+DURATION_TRIGGERS = """\
+create trigger if not exists {name}_duration_insert after insert on {table}
+when new.completed is not null and {when} begin
+{add}
+end;
+create trigger if not exists {name}_duration_update after update of completed on {table}
+when old.completed is null and new.completed is not null and {when} begin
+{add}
+end;
+"""
+
+
+def init_durations(connection):
     cursor = connection.cursor()
     cursor.execute(
-        f"""\
-INSERT INTO variable VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET value=?, state=?, updated=?
-WHERE updated <= excluded.updated
-""",
-        (
-            event["value"]["name"],
-            event["value"]["value"],
-            str(event["value"]["processInstanceKey"]),
-            str(event["value"]["processDefinitionKey"]),
-            maybe_str(event["value"]["scopeKey"])
-            if str(event["value"]["scopeKey"])
-            != str(event["value"]["processInstanceKey"])
-            else None,
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            # ON CONFLICT
-            event["value"]["name"],
-            event["intent"],
-            str(event["timestamp"]),
-        ),
+        """\
+create table if not exists duration(
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    elementId TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum INTEGER NOT NULL,
+    min INTEGER NOT NULL,
+    max INTEGER NOT NULL,
+    PRIMARY KEY (name, key, elementId, bucket)
+)
+"""
+    )
+    # The statistics and percentiles (upper bounds, from the histogram) of
+    # each duration.
+    cursor.execute(
+        """\
+create view if not exists duration_percentile as
+with cumulative as (
+    select name, key, elementId, bucket, sum, min, max,
+    sum(count) over (partition by name, key, elementId order by bucket) as below,
+    sum(count) over (partition by name, key, elementId) as count
+    from duration
+)
+select name, key, elementId, count, sum(sum) / count as mean, min(min) as min,
+max(max) as max,
+min(min(case when below >= 0.5 * count then 1 << bucket end), max(max)) as p50,
+min(min(case when below >= 0.9 * count then 1 << bucket end), max(max)) as p90,
+min(min(case when below >= 0.99 * count then 1 << bucket end), max(max)) as p99
+from cumulative
+group by name, key, elementId
+"""
     )
+    for name, (table, key, element, when) in DURATIONS.items():
+        cursor.execute(
+            DURATION_TRIGGERS.format(
+                name=name,
+                table=table,
+                when=when.format(row="new"),
+                add=DURATION_ADD.format(
+                    name=name,
+                    key=key.format(row="new"),
+                    element=element.format(row="new"),
+                ),
+            )
+        )
 
 
-def handle_incident(connection, event):
+def rebuild_durations(connection):
     cursor = connection.cursor()
-    cursor.execute(
-        f"""\
-INSERT INTO incident VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-ON CONFLICT DO UPDATE SET errorMessage=?, errorType=?, state=?, updated=?, completed=?
-WHERE updated <= excluded.updated
-""",
-        (
-            event["key"],
-            maybe_str(event["value"]["jobKey"]),
-            str(event["value"]["processInstanceKey"]),
-            str(event["value"]["processDefinitionKey"]),
-            str(event["value"]["elementInstanceKey"]),
-            event["value"]["elementId"],
-            # maybe_str(event["value"]["variableScopeKey"]),
-            event["value"]["errorMessage"],
-            event["value"]["errorType"],
-            event["intent"],
-            str(event["timestamp"]),
-            str(event["timestamp"]),
-            event["intent"] == "RESOLVED" and event["timestamp"] or None,
-            # ON CONFLICT
-            event["value"]["errorMessage"],
-            event["value"]["errorType"],
-            event["intent"],
-            str(event["timestamp"]),
-            event["intent"] == "RESOLVED" and event["timestamp"] or None,
-        ),
-    )
+    with connection:
+        cursor.execute("DELETE FROM duration")
+        for name, (table, key, element, when) in DURATIONS.items():
+            cursor.execute(
+                f"INSERT INTO duration"
+                f"(name, key, elementId, bucket, count, sum, min, max)"
+                f" SELECT '{name}', key, elementId, duration_bucket(duration),"
+                f" count(*), sum(duration), min(duration), max(duration) FROM ("
+                f"SELECT {key.format(row='t')} AS key,"
+                f" {element.format(row='t')} AS elementId,"
+                f" t.completed - t.created AS duration FROM {table} t"
+                f" WHERE t.completed IS NOT NULL AND {when.format(row='t')}"
+                f") WHERE key IS NOT NULL GROUP BY key, elementId, 4"
+            )
 
 
-def handle_zeebe_event(connection, event_type, event_id, event):
-    if event_type == "process":
-        handle_process(connection, event)
-    elif event_type == "process_instance":
-        handle_process_instance(connection, event)
-    elif event_type == "job":
-        handle_job(connection, event)
-    elif event_type == "decision_requirements":
-        handle_decision_requirements(connection, event)
-    elif event_type == "decision":
-        handle_decision(connection, event)
-    elif event_type == "decision_evaluation":
-        handle_decision_evaluation(connection, event)
-    elif event_type == "variable":
-        handle_variable(connection, event)
-    elif event_type == "incident":
-        handle_incident(connection, event)
-
-
-def main():
-    STREAMS = {
-        b"zeebe:DECISION": 0,
-        b"zeebe:DECISION_EVALUATION": 0,
-        b"zeebe:DECISION_REQUIREMENTS": 0,
-        b"zeebe:INCIDENT": 0,
-        b"zeebe:JOB": 0,
-        b"zeebe:PROCESS": 0,
-        b"zeebe:PROCESS_INSTANCE": 0,
-        b"zeebe:VARIABLE": 0,
-    }
-    logging.debug(STREAMS)
-    try:
-        connection = apsw.Connection("dbfile")
-        init_db(connection)
-    finally:
-        connection.close()
+# Full text search (datasette _search, GraphQL search:) by FTS5 tables with
+# a table as external content, maintained by triggers in the transaction of
+# the change: of all its rows, or of the rows matching a condition. The task
+# and incident lists search the open rows only, as the name of a task matches
+# a row of every process instance in the history. The FTS rows are keyed by
+# the rowid of the table, so they are rebuilt when the rowids change (migrate,
+# VACUUM).
+SEARCH = {
+    "element_instance_fts": ("element_instance", "elementName", "1"),
+    "incident_fts": ("incident", "errorMessage", "1"),
+    "job_fts": ("job", "customHeaders", "1"),
+    "variable_fts": ("variable", "value", "1"),
+    "open_task_fts": (
+        "element_instance",
+        "elementName",
+        "{row}.bpmnElementType = 'USER_TASK' and {row}.completed is null",
+    ),
+    "open_incident_fts": ("incident", "errorMessage", "{row}.completed is null"),
+}
 
-    while True:
-        try:
-            r = redis.Redis(host="localhost", port=6379, db=0)
-            logging.info("Connected.")
+SEARCH_TRIGGERS = """\
+create virtual table if not exists {name} using fts5({column}, content="{table}");
+create trigger if not exists {name}_insert after insert on {table}
+when {new} begin
+insert into {name}(rowid, {column}) values (new.rowid, new.{column});
+end;
+create trigger if not exists {name}_update after update of {columns} on {table}
+when ({old} or {new}) and (old.{column} is not new.{column} or ({old}) is not ({new}))
+begin
+insert into {name}({name}, rowid, {column})
+select 'delete', old.rowid, old.{column} where {old};
+insert into {name}(rowid, {column}) select new.rowid, new.{column} where {new};
+end;
+create trigger if not exists {name}_delete after delete on {table}
+when {old} begin
+insert into {name}({name}, rowid, {column})
+values ('delete', old.rowid, old.{column});
+end;
+"""
+
+
+def search_condition(column, when, row):
+    return f"({row}.{column} is not null and {when.format(row=row)})"
+
+
+def init_search(connection):
+    cursor = connection.cursor()
+    for name, (table, column, when) in SEARCH.items():
+        exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?", (name,)
+        ).fetchall()
+        cursor.execute(
+            SEARCH_TRIGGERS.format(
+                name=name,
+                table=table,
+                column=column,
+                columns=", ".join(
+                    sorted({column, *re.findall(r"\{row\}\.(\w+)", when)})
+                ),
+                old=search_condition(column, when, "old"),
+                new=search_condition(column, when, "new"),
+            )
+        )
+        if not exists:
+            rebuild_search(connection, [name])
+
+
+def rebuild_search(connection, names=SEARCH):
+    cursor = connection.cursor()
+    with connection:
+        for name in names:
+            table, column, when = SEARCH[name]
+            cursor.execute(f"INSERT INTO {name}({name}) VALUES ('delete-all')")
+            cursor.execute(
+                f"INSERT INTO {name}(rowid, {column})"
+                f" SELECT rowid, {column} FROM {table} t"
+                f" WHERE {search_condition(column, when, 't')}"
+            )
+
+
+# Read side queries of metadata.yaml and the Dashboard.ipynb GraphQL relations
+# with the index each of them is expected to use.
+QUERY_PLANS = [
+    (
+        "SELECT coalesce(sum(value), 0) AS count FROM counter"
+        " WHERE name = 'open_jobs' AND key = 'io.camunda.zeebe:userTask'",
+        "sqlite_autoindex_counter_1",
+    ),
+    (
+        "SELECT p.bpmnProcessName AS Process, SUM(c.value) AS Instances"
+        " FROM counter c"
+        " JOIN process p ON c.key = p.key"
+        " WHERE c.name = 'running_process_instances' AND c.value > 0"
+        " GROUP BY p.bpmnProcessName",
+        "sqlite_autoindex_counter_1",
+    ),
+    (
+        "SELECT count(*) FROM process_instance WHERE completed IS NULL",
+        "process_instance_open_key",
+    ),
+    (
+        "SELECT count(*) FROM job"
+        " WHERE type == 'io.camunda.zeebe:userTask' AND completed IS NULL",
+        "job_open",
+    ),
+    (
+        "SELECT count(*) FROM incident WHERE completed IS NULL",
+        "incident_open",
+    ),
+    (
+        "SELECT p.bpmnProcessName AS Process, COUNT(*) AS Instances"
+        " FROM process_instance pi"
+        " JOIN process p ON pi.processDefinition = p.key"
+        " WHERE completed IS NULL"
+        " GROUP BY p.bpmnProcessName",
+        "process_instance_open_key",
+    ),
+    (
+        "SELECT count(*) FROM element_instance"
+        " WHERE processInstance = ? AND bpmnElementType = 'USER_TASK'"
+        " AND completed IS NULL",
+        "element_instance_process_instance",
+    ),
+    (
+        "SELECT * FROM element_instance WHERE processInstance = ?",
+        "element_instance_process_instance",
+    ),
+    (
+        "SELECT count(*) FROM incident"
+        " WHERE processInstance = ? AND completed IS NULL",
+        "incident_process_instance",
+    ),
+    (
+        "SELECT * FROM incident WHERE processInstance = ?",
+        "incident_process_instance",
+    ),
+    (
+        "SELECT * FROM process_instance WHERE completed IS NULL"
+        " ORDER BY key LIMIT 101",
+        "process_instance_open_key",
+    ),
+    (
+        "SELECT * FROM job WHERE completed IS NULL AND state != 'COMPLETED'"
+        " ORDER BY key LIMIT 1001",
+        "job_open_key",
+    ),
+    (
+        "SELECT * FROM job WHERE processInstance = ?",
+        "job_process_instance",
+    ),
+    (
+        "SELECT * FROM variable WHERE processInstance = ?",
+        "variable_process_instance",
+    ),
+    (
+        "SELECT * FROM decision_evaluation WHERE processInstance = ?",
+        "decision_evaluation_process_instance",
+    ),
+]
+
+
+def check_query_plans(connection):
+    cursor = connection.cursor()
+    failures = []
+    for query, index in QUERY_PLANS:
+        plan = [
+            row[-1]
+            for row in cursor.execute(
+                "EXPLAIN QUERY PLAN " + query, (None,) * query.count("?")
+            )
+        ]
+        if not any(index in detail.split() for detail in plan):
+            failures.append((query, index, plan))
+    return failures
+
+
+def load_checkpoints(connection, streams):
+    cursor = connection.cursor()
+    for stream, id_ in cursor.execute("SELECT stream, id FROM checkpoint"):
+        if stream.encode("utf-8") in streams:
+            streams[stream.encode("utf-8")] = id_.encode("utf-8")
+
+
+def save_checkpoints(connection, positions):
+    cursor = connection.cursor()
+    cursor.executemany(
+        """\
+INSERT INTO checkpoint VALUES (?, ?)
+ON CONFLICT DO UPDATE SET id=excluded.id
+""",
+        [
+            (stream.decode("utf-8"), id_.decode("utf-8"))
+            for stream, id_ in positions.items()
+        ],
+    )
+
+
+def execute_rows(connection, rows):
+    cursor = connection.cursor()
+    for statement, params in rows:
+        cursor.execute(statement, params)
+
+
+# Record types are projected into tables declaratively: for every table a
+# record type writes, the key columns, an expression per column and the
+# columns its UPSERT updates, guarded by "WHERE updated <= excluded.updated".
+# The expressions of a record type are compiled into one function returning
+# its (statement, params) rows; they see the record as event, its value and
+# intent, its timestamp as text, the rows built so far (for spill() and
+# store_resource()), and the connection (for element_name()).
+Projection = namedtuple(
+    "Projection", ["table", "key", "columns", "update", "when"], defaults=[None]
+)
+
+PROJECTIONS = {
+    "process": [
+        Projection(
+            "process",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "bpmnProcessId": 'value["bpmnProcessId"]',
+                "bpmnProcessName": '""',
+                "version": 'value["version"]',
+                "resourceName": 'value["resourceName"]',
+                "resource": 'store_resource(value["resource"], rows)',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+            },
+            ("version", "resourceName", "resource", "state", "updated"),
+        ),
+    ],
+    "process_instance": [
+        Projection(
+            "process_instance",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "parentProcessInstance": 'maybe_str(value["parentProcessInstanceKey"])',
+                "parentElementInstance": 'maybe_str(value["parentElementInstanceKey"])',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "ELEMENT_COMPLETED" and timestamp or None',
+            },
+            ("state", "updated", "completed"),
+            when='value["elementId"] == value["bpmnProcessId"]',
+        ),
+        Projection(
+            "element_instance",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "processInstance": 'str(value["processInstanceKey"])',
+                "elementId": 'value["elementId"]',
+                "elementName": "element_name(connection, value)",
+                "bpmnElementType": 'value["bpmnElementType"]',
+                "flowScopeKey": 'maybe_str(value["flowScopeKey"]) or str(event.key)',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent in ("ELEMENT_COMPLETED", "SEQUENCE_FLOW_TAKEN")'
+                " and timestamp or None",
+            },
+            ("elementName", "flowScopeKey", "state", "updated", "completed"),
+            when='value["bpmnElementType"] not in ("SEQUENCE_FLOW", "PROCESS")',
+        ),
+    ],
+    "job": [
+        Projection(
+            "job",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "type": 'value["type"]',
+                "processInstance": 'str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "elementInstance": 'str(value["elementInstanceKey"])',
+                "customHeaders": 'json.dumps(value["customHeaders"])',
+                "variables": 'spill(json.dumps(value["variables"]), rows)',
+                "form": "job_form(value)",
+                "worker": 'value["worker"]',
+                "errorCode": 'value["errorCode"]',
+                "errorMessage": 'value["errorMessage"]',
+                "state": "intent",
+                "retryBackoff": 'value["retryBackoff"]',
+                "recurringTime": 'value["recurringTime"]',
+                "retries": 'value["retries"]',
+                "deadline": 'value["deadline"]',
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "COMPLETED" and timestamp or None',
+            },
+            (
+                "variables",
+                "worker",
+                "errorCode",
+                "errorMessage",
+                "state",
+                "retryBackoff",
+                "recurringTime",
+                "retries",
+                "deadline",
+                "updated",
+                "completed",
+            ),
+        ),
+    ],
+    "decision_requirements": [
+        Projection(
+            "decision_requirements",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "decisionRequirementsId": 'value["decisionRequirementsId"]',
+                "decisionRequirementsName": 'value["decisionRequirementsName"]',
+                "version": 'value["decisionRequirementsVersion"]',
+                "resource": 'store_resource(value["resource"], rows)',
+                "resourceName": 'value["resourceName"]',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+            },
+            (
+                "decisionRequirementsId",
+                "decisionRequirementsName",
+                "version",
+                "resource",
+                "resourceName",
+                "state",
+                "updated",
+            ),
+        ),
+    ],
+    "decision": [
+        Projection(
+            "decision",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "decisionId": 'value["decisionId"]',
+                "decisionName": 'value["decisionName"]',
+                "decisionRequirements": 'str(value["decisionRequirementsKey"])',
+                "version": 'value["version"]',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+            },
+            (
+                "decisionId",
+                "decisionName",
+                "decisionRequirements",
+                "version",
+                "state",
+                "updated",
+            ),
+        ),
+    ],
+    "decision_evaluation": [
+        Projection(
+            "decision_evaluation",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "processInstance": 'str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "elementInstance": 'str(value["elementInstanceKey"])',
+                "decisionRequirements": 'str(value["decisionRequirementsKey"])',
+                "decision": 'str(value["decisionKey"])',
+                "decisionOutput": 'json.dumps(value["decisionOutput"])',
+                "evaluatedDecisions": 'json.dumps(value["evaluatedDecisions"])',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "EVALUATED" and timestamp or None',
+            },
+            ("decisionOutput", "evaluatedDecisions", "state", "updated", "completed"),
+        ),
+    ],
+    "variable": [
+        Projection(
+            "variable",
+            ("name", "processInstance", "flowScope"),
+            {
+                "name": 'value["name"]',
+                "value": 'spill(value["value"], rows)',
+                "processInstance": 'str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "flowScope": 'value["scopeKey"] != value["processInstanceKey"]'
+                ' and maybe_str(value["scopeKey"]) or None',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+            },
+            ("value", "state", "updated"),
+        ),
+    ],
+    "incident": [
+        Projection(
+            "incident",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "job": 'maybe_str(value["jobKey"])',
+                "processInstance": 'str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "elementInstance": 'str(value["elementInstanceKey"])',
+                "elementId": 'value["elementId"]',
+                "errorMessage": 'value["errorMessage"]',
+                "errorType": 'value["errorType"]',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "RESOLVED" and timestamp or None',
+            },
+            ("errorMessage", "errorType", "state", "updated", "completed"),
+        ),
+    ],
+    "message": [
+        Projection(
+            "message",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "name": 'value["name"]',
+                "correlationKey": 'value["correlationKey"]',
+                "messageId": 'value["messageId"] or None',
+                "timeToLive": 'value["timeToLive"]',
+                "deadline": 'value.get("deadline")',
+                "variables": 'spill(json.dumps(value["variables"]), rows)',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "EXPIRED" and timestamp or None',
+            },
+            ("state", "updated", "completed"),
+        ),
+    ],
+    "timer": [
+        Projection(
+            "timer",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "processInstance": 'maybe_str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "elementInstance": 'maybe_str(value["elementInstanceKey"])',
+                "targetElementId": 'value["targetElementId"]',
+                "dueDate": 'value["dueDate"]',
+                "repetitions": 'value["repetitions"]',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent in ("TRIGGERED", "CANCELED") and timestamp'
+                " or None",
+            },
+            ("dueDate", "repetitions", "state", "updated", "completed"),
+        ),
+    ],
+    "user_task": [
+        Projection(
+            "user_task",
+            ("key",),
+            {
+                "key": "str(event.key)",
+                "processInstance": 'str(value["processInstanceKey"])',
+                "processDefinition": 'str(value["processDefinitionKey"])',
+                "elementInstance": 'str(value["elementInstanceKey"])',
+                "elementId": 'value["elementId"]',
+                "assignee": 'value.get("assignee") or None',
+                "candidateGroups": 'json.dumps(value.get("candidateGroupsList", []))',
+                "candidateUsers": 'json.dumps(value.get("candidateUsersList", []))',
+                "dueDate": 'value.get("dueDate") or None',
+                "followUpDate": 'value.get("followUpDate") or None',
+                "formKey": 'maybe_str(value.get("formKey", -1))',
+                "variables": 'spill(json.dumps(value["variables"]), rows)',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent in ("COMPLETED", "CANCELED") and timestamp'
+                " or None",
+            },
+            (
+                "assignee",
+                "candidateGroups",
+                "candidateUsers",
+                "dueDate",
+                "followUpDate",
+                "formKey",
+                "variables",
+                "state",
+                "updated",
+                "completed",
+            ),
+        ),
+    ],
+    "process_message_subscription": [
+        Projection(
+            "process_message_subscription",
+            ("elementInstance", "messageName"),
+            {
+                "elementInstance": 'str(value["elementInstanceKey"])',
+                "messageName": 'value["messageName"]',
+                "processInstance": 'str(value["processInstanceKey"])',
+                "elementId": 'value["elementId"]',
+                "correlationKey": 'value["correlationKey"]',
+                "messageKey": 'maybe_str(value["messageKey"])',
+                "interrupting": 'value["interrupting"]',
+                "variables": 'spill(json.dumps(value["variables"]), rows)',
+                "state": "intent",
+                "created": "timestamp",
+                "updated": "timestamp",
+                "completed": 'intent == "DELETED" and timestamp or None',
+            },
+            (
+                "correlationKey",
+                "messageKey",
+                "variables",
+                "state",
+                "updated",
+                "completed",
+            ),
+        ),
+    ],
+}
+
+
+def element_name(connection, value):
+    definition = DEFINITIONS.get(connection, str(value["processDefinitionKey"]))
+    return definition and definition.element_names.get(value["elementId"]) or ""
+
+
+def job_form(value):
+    return (value["customHeaders"].get("io.camunda.zeebe:formKey") or "").rsplit(
+        ":", 1
+    )[-1] or None
+
+
+def store_resource(resource, rows):
+    digest, row = resource_row(resource)
+    rows.append(row)
+    return digest
+
+
+def upsert_statement(projection):
+    return f"""\
+INSERT INTO {projection.table} ({", ".join(projection.columns)})
+VALUES ({", ".join("?" for _ in projection.columns)})
+ON CONFLICT DO UPDATE SET {", ".join(f"{c}=excluded.{c}" for c in projection.update)}
+WHERE updated <= excluded.updated
+"""
+
+
+UPSERTS = {
+    projection.table: upsert_statement(projection)
+    for projections in PROJECTIONS.values()
+    for projection in projections
+}
+
+
+def projection_rows(event_type, projections):
+    lines = [
+        "def rows(event, connection=None):",
+        "    value = event.value",
+        "    intent = event.intent",
+        "    timestamp = str(event.timestamp)",
+        "    rows = []",
+    ]
+    namespace = dict(globals())
+    for i, projection in enumerate(projections):
+        namespace[f"statement_{i}"] = UPSERTS[projection.table]
+        indent = "    "
+        if projection.when:
+            lines.append(f"    if {projection.when}:")
+            indent = "        "
+        lines.append(
+            f"{indent}rows.append((statement_{i}, ("
+            + ", ".join(projection.columns.values())
+            + ",)))"
+        )
+    lines.append("    return rows")
+    exec(compile("\n".join(lines), f"<projection {event_type}>", "exec"), namespace)
+    return namespace["rows"]
+
+
+ZEEBE_EVENT_ROWS = {
+    event_type: projection_rows(event_type, projections)
+    for event_type, projections in PROJECTIONS.items()
+}
+
+
+def handle_process(connection, event):
+    execute_rows(connection, ZEEBE_EVENT_ROWS["process"](event))
+    DEFINITIONS.invalidate(str(event.value["processDefinitionKey"]))
+    definition = DEFINITIONS.get(connection, str(event.value["processDefinitionKey"]))
+    if definition is None:
+        return
+    cursor = connection.cursor()
+    cursor.execute(
+        "UPDATE process SET bpmnProcessName=? WHERE key=?",
+        (
+            definition.process_name,
+            str(event.value["processDefinitionKey"]),
+        ),
+    )
+    for form_key, schema in definition.forms:
+        cursor.execute(
+            f"""\
+INSERT INTO form VALUES (?, ?, ?)
+ON CONFLICT DO UPDATE SET schema=excluded.schema
+""",
+            (form_key, str(event.value["processDefinitionKey"]), schema),
+        )
+
+
+def handle_process_instance(connection, event):
+    execute_rows(connection, ZEEBE_EVENT_ROWS["process_instance"](event, connection))
+
+
+# Record types whose rows depend on the database (process definitions) or
+# that update it otherwise; the rows of the others are built in make_record().
+ZEEBE_EVENT_HANDLERS = {
+    "process": handle_process,
+    "process_instance": handle_process_instance,
+}
+
+
+def handle_zeebe_event(connection, event_type, event_id, event):
+    handler = ZEEBE_EVENT_HANDLERS.get(event_type)
+    if handler is not None:
+        handler(connection, event)
+    elif event_type in ZEEBE_EVENT_ROWS:
+        execute_rows(connection, ZEEBE_EVENT_ROWS[event_type](event))
+
+
+STORAGE_PROFILES = {
+    # Only for loading a new database from scratch: a crash corrupts it.
+    "bulk": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "OFF",
+        "synchronous": "OFF",
+        "locking_mode": "EXCLUSIVE",
+        "cache_size": -256 * 1024,
+    },
+    "rollback": {
+        "busy_timeout": 5000,
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+    },
+    # Readers (datasette) and the importer do not block each other in WAL
+    # mode. With synchronous=NORMAL a power loss may roll back the last
+    # batches, which are then re-read from the stream checkpoints.
+    "wal": {
+        "busy_timeout": 5000,
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+
+def connect(path, profile="wal"):
+    # One long-lived connection also keeps apsw's prepared statement cache
+    # warm, so the handle_* statements are compiled only once.
+    connection = apsw.Connection(path, statementcachesize=256)
+    connection.createscalarfunction(
+        "inflate_base64", inflate_base64, 1, deterministic=True
+    )
+    connection.createscalarfunction("inflate_text", inflate_text, 1, deterministic=True)
+    connection.createscalarfunction(
+        "duration_bucket", duration_bucket, 1, deterministic=True
+    )
+    cursor = connection.cursor()
+    for pragma, value in STORAGE_PROFILES[profile].items():
+        cursor.execute(f"PRAGMA {pragma}={value}").fetchall()
+    return connection
+
+
+class WalCheckpointPolicy:
+    def __init__(self, interval=10.0, truncate_pages=10000):
+        self.interval = interval
+        self.truncate_pages = truncate_pages
+        self.last = time.monotonic()
+
+    def __call__(self, connection):
+        # Runs between batches, so it never competes with our own writes.
+        if not self.interval or time.monotonic() - self.last < self.interval:
+            return
+        self.last = time.monotonic()
+        wal_pages, _ = connection.wal_checkpoint(mode=apsw.SQLITE_CHECKPOINT_PASSIVE)
+        if wal_pages >= self.truncate_pages:
+            try:
+                connection.wal_checkpoint(mode=apsw.SQLITE_CHECKPOINT_TRUNCATE)
+            except apsw.BusyError:
+                logging.info("WAL truncate postponed by active readers.")
+
+
+WAL_CHECKPOINT = WalCheckpointPolicy()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ReplicaPolicy:
+    def __init__(self, paths=(), interval=60.0, pages=1000):
+        self.paths = list(paths)
+        self.interval = interval
+        self.pages = pages
+        self.last = None
+        self.changes = None
+        self.target = None
+        self.backup = None
+
+    def start(self, connection):
+        snapshot = f"{self.paths[0]}.tmp"
+        remove_file(snapshot)
+        remove_file(f"{snapshot}-journal")
+        self.last = time.monotonic()
+        self.target = apsw.Connection(snapshot)
+        self.backup = self.target.backup("main", connection, "main")
+
+    def swap(self):
+        snapshot = f"{self.paths[0]}.tmp"
+        self.backup.finish()
+        # Copied with the header of the WAL mode source, which immutable
+        # readers could not open without its -wal file.
+        self.target.cursor().execute("PRAGMA journal_mode=DELETE").fetchall()
+        self.target.close()
+        self.target = self.backup = None
+        # The replicas are never written, so they can share one file.
+        for path in self.paths[1:]:
+            remove_file(f"{path}.tmp")
+            try:
+                os.link(snapshot, f"{path}.tmp")
+            except OSError:
+                shutil.copyfile(snapshot, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        os.replace(snapshot, self.paths[0])
+        logging.info("Replaced replicas %s.", ", ".join(self.paths))
+
+    def close(self):
+        # Drops an unfinished snapshot when the importer stops.
+        if self.backup is None:
+            return
+        snapshot = f"{self.paths[0]}.tmp"
+        self.backup.close(True)
+        self.target.close(True)
+        self.target = self.backup = None
+        remove_file(snapshot)
+        remove_file(f"{snapshot}-journal")
+
+    def __call__(self, connection, idle=False):
+        # Runs between batches and copies a few pages of a snapshot at a time,
+        # all of the rest once the streams are idle. Changes the importer
+        # writes meanwhile are copied along by SQLite, as they are written
+        # through the same connection.
+        if not self.paths:
+            return
+        if self.backup is None:
+            if self.last is not None and time.monotonic() - self.last < self.interval:
+                return
+            if connection.total_changes() == self.changes:
+                return
+            self.start(connection)
+        try:
+            self.backup.step(-1 if idle else self.pages)
+        except (apsw.BusyError, apsw.LockedError):
+            logging.info("Replica snapshot postponed by a lock.")
+            return
+        if self.backup.done:
+            self.changes = connection.total_changes()
+            self.swap()
+
+
+REPLICAS = ReplicaPolicy()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(
+                f'{name}_bucket{{{labels}{labels and ","}le="{le}"}} {cumulative}'
+            )
+        labels = labels and f"{{{labels}}}"
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+LATENCY_BUCKETS = [
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.1,
+    1.0,
+]
+
+BATCH_SIZE_BUCKETS = [1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Metrics:
+    # Recording is a few dictionary and list updates per event; everything
+    # else (cache ratio, stream lag) is computed when the metrics are scraped.
+
+    def __init__(self):
+        self.enabled = False
+        self.events = defaultdict(int)
+        self.handlers = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.commit = Histogram(LATENCY_BUCKETS)
+        self.reconnects = 0
+        self.streams = {}
+        self.redis_url = None
+
+    def observe_event(self, event_type, intent, seconds):
+        self.events[(event_type, intent)] += 1
+        self.handlers[event_type].observe(seconds)
+
+    def observe_batch(self, size, commit_seconds):
+        self.batch_size.observe(size)
+        self.commit.observe(commit_seconds)
+
+    def stream_lag(self):
+        r = redis.Redis.from_url(self.redis_url)
+        try:
+            for stream_name, position in list(self.streams.items()):
+                try:
+                    newest = r.xinfo_stream(stream_name)["last-generated-id"]
+                except redis.ResponseError:
+                    continue
+                if isinstance(position, bytes):
+                    position = position.decode("utf-8")
+                applied = int(str(position).split("-", 1)[0])
+                newest = int(newest.split(b"-", 1)[0])
+                yield stream_name.decode("utf-8"), max(0, newest - applied) / 1000
+        finally:
+            r.close()
+
+    def render(self):
+        lines = [
+            "# TYPE importer_events_total counter",
+            *(
+                f'importer_events_total{{stream="{event_type}",intent="{intent}"}}'
+                f" {count}"
+                for (event_type, intent), count in sorted(self.events.items())
+            ),
+            "# TYPE importer_handler_seconds histogram",
+        ]
+        for event_type, histogram in sorted(self.handlers.items()):
+            lines.extend(
+                histogram.render(
+                    "importer_handler_seconds", f'handler="handle_{event_type}"'
+                )
+            )
+        lines.append("# TYPE importer_batch_size histogram")
+        lines.extend(self.batch_size.render("importer_batch_size"))
+        lines.append("# TYPE importer_commit_seconds histogram")
+        lines.extend(self.commit.render("importer_commit_seconds"))
+        lookups = DEFINITIONS.hits + DEFINITIONS.misses
+        lines.extend(
+            [
+                "# TYPE importer_definition_cache_hits_total counter",
+                f"importer_definition_cache_hits_total {DEFINITIONS.hits}",
+                "# TYPE importer_definition_cache_misses_total counter",
+                f"importer_definition_cache_misses_total {DEFINITIONS.misses}",
+                "# TYPE importer_definition_cache_hit_ratio gauge",
+                "importer_definition_cache_hit_ratio "
+                f"{lookups and DEFINITIONS.hits / lookups or 0}",
+                "# TYPE importer_reconnects_total counter",
+                f"importer_reconnects_total {self.reconnects}",
+            ]
+        )
+        if self.redis_url:
+            lines.append("# TYPE importer_stream_lag_seconds gauge")
+            try:
+                for stream, lag in self.stream_lag():
+                    lines.append(
+                        f'importer_stream_lag_seconds{{stream="{stream}"}} {lag}'
+                    )
+            except redis.RedisError as e:
+                logging.warning("Could not read stream lag: %s", e)
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, streams, redis_url):
+        metrics = self
+        self.enabled = True
+        self.streams = streams
+        self.redis_url = redis_url
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("Serving metrics on port %d.", port)
+        return server
+
+
+METRICS = Metrics()
+
+
+class Watermark:
+    # Publishes the stream positions and the touched Zeebe keys of every
+    # committed batch, for readers waiting to see their own writes.
+    KEYS = {
+        UPSERTS[projection.table]
+        for projections in PROJECTIONS.values()
+        for projection in projections
+        if projection.key == ("key",)
+    }
+
+    def __init__(self):
+        self.client = None
+        self.channel = watermark.CHANNEL
+
+    def keys(self, batch):
+        keys = set()
+        for _, records in batch:
+            for event_type, intent, event_id, event, rows in records:
+                if event is not None:
+                    keys.add(str(event.key))
+                    continue
+                for statement, params in rows:
+                    if statement in self.KEYS:
+                        keys.add(str(params[0]))
+        return keys
+
+    def publish(self, batch, positions):
+        if self.client is None:
+            return
+        try:
+            self.client.publish(
+                self.channel, watermark.encode(positions, self.keys(batch))
+            )
+        except redis.RedisError as e:
+            logging.warning("Publishing the watermark failed: %s", e)
+
+
+WATERMARK = Watermark()
+
+
+def parse_stream_id(id_):
+    if isinstance(id_, bytes):
+        id_ = id_.decode("utf-8")
+    ms, _, seq = str(id_).partition("-")
+    return int(ms), int(seq or 0)
+
+
+class ConsumerGroup:
+    # Reads the streams through a consumer group instead of XREAD, for
+    # StreamTrim to acknowledge the applied entries. The group restarts from
+    # the committed checkpoints, so entries delivered but never committed are
+    # delivered again.
+    def __init__(self, r, group, streams, consumer="importer"):
+        self.r = r
+        self.group = group
+        self.consumer = consumer
+        self.delivered = defaultdict(deque)
+        self.undelivered = deque()
+        for stream_name, position in streams.items():
+            try:
+                r.xgroup_create(stream_name, group, id=position, mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+                r.xgroup_setid(stream_name, group, id=position)
+
+    def xread(self, streams, count=None, block=None):
+        if not self.undelivered:
+            for stream_name, stream_items in (
+                self.r.xreadgroup(
+                    self.group,
+                    self.consumer,
+                    {stream_name: ">" for stream_name in streams},
+                    count=count,
+                    block=block,
+                )
+                or []
+            ):
+                self.delivered[stream_name].extend(id_ for id_, _ in stream_items)
+                self.undelivered.append((stream_name, stream_items))
+        # COUNT applies per stream, and the group does not deliver an entry
+        # twice, so the entries over count are kept for the next call.
+        result = []
+        while self.undelivered and count != 0:
+            stream_name, stream_items = self.undelivered.popleft()
+            if count is not None:
+                if len(stream_items) > count:
+                    self.undelivered.appendleft((stream_name, stream_items[count:]))
+                    stream_items = stream_items[:count]
+                count -= len(stream_items)
+            result.append((stream_name, stream_items))
+        return result
+
+    def ack(self, positions):
+        for stream_name, position in positions.items():
+            delivered = self.delivered[stream_name]
+            position = parse_stream_id(position)
+            ids = []
+            while delivered and parse_stream_id(delivered[0]) <= position:
+                ids.append(delivered.popleft())
+            if ids:
+                self.r.xack(stream_name, self.group, *ids)
+
+    def __getattr__(self, name):
+        return getattr(self.r, name)
+
+
+class StreamTrim:
+    # Trims the streams after each committed batch, keeping the entries of
+    # the last lag seconds before the applied positions, or acknowledges
+    # the applied entries when reading through a consumer group.
+    def __init__(self):
+        self.client = None
+        self.lag = None
+        self.group = None
+        self.trimmed = {}
+        # The other shards, whose checkpoints bound what shard 0 trims.
+        self.shards = []
+        self.connections = {}
+
+    def applied(self, positions):
+        positions = dict(positions)
+        for path in self.shards:
+            try:
+                if path not in self.connections:
+                    self.connections[path] = apsw.Connection(
+                        path, flags=apsw.SQLITE_OPEN_READONLY
+                    )
+                checkpoints = {
+                    stream.encode("utf-8"): id_.encode("utf-8")
+                    for stream, id_ in self.connections[path].execute(
+                        "SELECT stream, id FROM checkpoint"
+                    )
+                }
+            except apsw.Error:
+                return {}
+            positions = {
+                stream_name: min(
+                    position, checkpoints[stream_name], key=parse_stream_id
+                )
+                for stream_name, position in positions.items()
+                if stream_name in checkpoints
+            }
+        return positions
+
+    def __call__(self, positions):
+        if self.group is not None:
+            try:
+                self.group.ack(positions)
+            except redis.RedisError as e:
+                logging.warning("Acknowledging the applied entries failed: %s", e)
+            return
+        if self.client is None or self.lag is None:
+            return
+        try:
+            for stream_name, position in self.applied(positions).items():
+                ms = parse_stream_id(position)[0] - int(self.lag * 1000)
+                if ms > self.trimmed.get(stream_name, 0):
+                    self.client.xtrim(stream_name, minid=f"{ms}-0", approximate=True)
+                    self.trimmed[stream_name] = ms
+        except redis.RedisError as e:
+            logging.warning("Trimming the streams failed: %s", e)
+
+
+STREAM_TRIM = StreamTrim()
+
+
+def zeebe_event_type(stream_name):
+    return stream_name.decode("utf-8").split(":", 1)[-1].lower()
+
+
+def read_batch(r, streams, batch_size, batch_latency):
+    positions = dict(streams)
+    batch = []
+    count = 0
+    block = 30 * 1000
+    deadline = None
+    while count < batch_size:
+        result = r.xread(positions, count=batch_size - count, block=block)
+        for stream_name, stream_items in result or []:
+            # COUNT applies per stream: the entries over the batch size are
+            # read again from the position of the last one kept.
+            stream_items = stream_items[: batch_size - count]
+            if not stream_items:
+                break
+            batch.append((stream_name, stream_items))
+            positions[stream_name] = stream_items[-1][0]
+            count += len(stream_items)
+        if not count:
+            break
+        if deadline is None:
+            deadline = time.monotonic() + batch_latency
+        block = int((deadline - time.monotonic()) * 1000)
+        if block < 1:
+            break
+    return batch, positions
+
+
+def make_record(zeebe_event_type, zeebe_event_id, zeebe_event):
+    # Records whose rows do not depend on the database are turned into
+    # (statement, params) rows here, so that this can run in a worker process.
+    rows = ZEEBE_EVENT_ROWS.get(zeebe_event_type)
+    intent = zeebe_event.intent
+    if rows is None or zeebe_event_type in ZEEBE_EVENT_HANDLERS:
+        return zeebe_event_type, intent, zeebe_event_id, zeebe_event, None
+    return zeebe_event_type, intent, zeebe_event_id, None, rows(zeebe_event)
+
+
+def decode_entries(zeebe_event_type, stream_items):
+    records = []
+    for stream_event_id, zeebe_events in stream_items:
+        for zeebe_event_id, zeebe_event in zeebe_events.items():
+            if not SHARD(zeebe_event_type, zeebe_event):
+                continue
+            zeebe_event = decode_event(zeebe_event)
+            if zeebe_event is None:
+                continue
+            records.append(make_record(zeebe_event_type, zeebe_event_id, zeebe_event))
+    return records
+
+
+def decode_batch(batch):
+    return [
+        (stream_name, decode_entries(zeebe_event_type(stream_name), stream_items))
+        for stream_name, stream_items in batch
+    ]
+
+
+# Zeebe keys carry the ID of the partition that created them above these
+# bits. Every record of a process instance is written on its partition.
+PARTITION_BITS = 51
+
+PARTITION_ID = re.compile(rb'"partitionId":\s*(\d+)')
+
+# Definitions are replicated to every shard, for the element names and forms.
+REPLICATED_EVENT_TYPES = {"process", "decision_requirements", "decision"}
+
+
+class ShardFilter:
+    # With --shard, keeps the entries of the partitions of that shard (and
+    # the definitions), mostly without parsing the others.
+    def __init__(self):
+        self.shard = None
+        self.shards = 1
+
+    def __call__(self, zeebe_event_type, data):
+        if self.shard is None or zeebe_event_type in REPLICATED_EVENT_TYPES:
+            return True
+        match = PARTITION_ID.search(data)
+        if match is not None:
+            partition = int(match.group(1))
+        else:
+            partition = loads(data).get("key", -1) >> PARTITION_BITS
+        return (partition - 1) % self.shards == self.shard
+
+
+SHARD = ShardFilter()
+
+
+def apply_records(connection, records):
+    for event_type, intent, event_id, event, rows in records:
+        started = time.perf_counter()
+        if rows is None:
+            handle_zeebe_event(connection, event_type, event_id, event)
+        else:
+            execute_rows(connection, rows)
+        if METRICS.enabled:
+            METRICS.observe_event(event_type, intent, time.perf_counter() - started)
+
+
+# For the UPSERT statements guarded by "WHERE updated <= excluded.updated":
+# the positions of the key columns, and of the created and updated values.
+COALESCE = {
+    UPSERTS[projection.table]: (
+        tuple(list(projection.columns).index(column) for column in projection.key),
+        list(projection.columns).index("created"),
+        list(projection.columns).index("updated"),
+    )
+    for projections in PROJECTIONS.values()
+    for projection in projections
+}
+COALESCE[RESOURCE_INSERT] = ((0,), None, None)
+COALESCE[PAYLOAD_INSERT] = ((0,), None, None)
+
+
+def coalesce_rows(pending, rows):
+    # Keeps only the row that the sequential UPSERTs would have left behind:
+    # the latest update wins (later on ties), but created is the first seen.
+    # Content-addressed inserts are kept once.
+    for statement, params in rows:
+        key_columns, created, updated = COALESCE[statement]
+        key = (statement, *(params[i] for i in key_columns))
+        previous = pending.get(key)
+        if previous is None:
+            pending[key] = params
+        elif updated is not None and previous[updated] <= params[updated]:
+            pending[key] = (
+                params[:created] + (previous[created],) + params[created + 1 :]
+            )
+
+
+def apply_records_coalesced(connection, records):
+    pending = {}
+    cursor = connection.cursor()
+
+    def flush():
+        for (statement, *_), params in pending.items():
+            cursor.execute(statement, params)
+        pending.clear()
+
+    for event_type, intent, event_id, event, rows in records:
+        started = time.perf_counter()
+        if rows is None and event_type == "process_instance":
+            rows = ZEEBE_EVENT_ROWS[event_type](event, connection)
+        if rows is not None and all(statement in COALESCE for statement, _ in rows):
+            coalesce_rows(pending, rows)
+        else:
+            # Everything else is applied in order, after the rows before it.
+            flush()
+            if rows is None:
+                handle_zeebe_event(connection, event_type, event_id, event)
+            else:
+                execute_rows(connection, rows)
+        if METRICS.enabled:
+            METRICS.observe_event(event_type, intent, time.perf_counter() - started)
+    flush()
+
+
+def apply_batch(connection, batch, positions, coalesce=False):
+    started = time.perf_counter()
+    positions = {
+        stream_name: positions[stream_name]
+        for stream_name, _ in batch
+        if stream_name in positions
+    }
+    with connection:
+        if coalesce:
+            apply_records_coalesced(
+                connection, [r for _, records in batch for r in records]
+            )
+        else:
+            for stream_name, records in batch:
+                apply_records(connection, records)
+        save_checkpoints(connection, positions)
+        applied = time.perf_counter()
+    if METRICS.enabled:
+        METRICS.observe_batch(
+            sum(len(records) for _, records in batch),
+            time.perf_counter() - applied,
+        )
+    WATERMARK.publish(batch, positions)
+    STREAM_TRIM(positions)
+    WAL_CHECKPOINT(connection)
+    REPLICAS(connection)
+
+
+def ingest(connection, r, streams, batch_size, batch_latency, coalesce=False):
+    while True:
+        batch, positions = read_batch(r, streams, batch_size, batch_latency)
+        if batch:
+            apply_batch(connection, decode_batch(batch), positions, coalesce)
+            streams.update(positions)
+            logging.debug(
+                "Definition cache hits: %d, misses: %d.",
+                DEFINITIONS.hits,
+                DEFINITIONS.misses,
+            )
+        else:
+            REPLICAS(connection, idle=True)
+
+
+def ingest_pipelined(
+    connection, r, streams, batch_size, batch_latency, workers, prefetch, coalesce=False
+):
+    # Reader thread -> worker processes -> this (the only writer) thread.
+    # The bounded queue of submitted batches is the backpressure for both
+    # the reader and the decoding workers.
+    batches = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+    chunk_size = max(1, batch_size // workers)
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        positions = dict(streams)
+        try:
+            while not stopped.is_set():
+                batch, positions = read_batch(r, positions, batch_size, batch_latency)
+                if batch:
+                    put(
+                        (
+                            [
+                                (
+                                    stream_name,
+                                    pool.submit(
+                                        decode_entries,
+                                        zeebe_event_type(stream_name),
+                                        stream_items[i : i + chunk_size],
+                                    ),
+                                )
+                                for stream_name, stream_items in batch
+                                for i in range(0, len(stream_items), chunk_size)
+                            ],
+                            positions,
+                        )
+                    )
+        except BaseException as e:
+            # Raised again by the writer, which would wait forever otherwise.
+            put(e)
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=set_payload_threshold,
+        initargs=(PAYLOAD_THRESHOLD,),
+    ) as pool:
+        reading = threading.Thread(target=reader, daemon=True)
+        reading.start()
+        try:
             while True:
-                for stream_data in r.xread(STREAMS, block=30 * 1000):
-                    stream_name, stream_items = stream_data
-                    zeebe_event_type = (
-                        stream_name.decode("utf-8").split(":", 1)[-1].lower()
+                try:
+                    item = batches.get(timeout=1)
+                except queue.Empty:
+                    if not reading.is_alive() and batches.empty():
+                        raise RuntimeError("The reader thread stopped.")
+                    REPLICAS(connection, idle=True)
+                    continue
+                if isinstance(item, BaseException):
+                    raise item
+                futures, positions = item
+                batch = [
+                    (stream_name, future.result()) for stream_name, future in futures
+                ]
+                apply_batch(connection, batch, positions, coalesce)
+                streams.update(positions)
+                logging.debug(
+                    "Definition cache hits: %d, misses: %d.",
+                    DEFINITIONS.hits,
+                    DEFINITIONS.misses,
+                )
+        finally:
+            stopped.set()
+
+
+def backoff_delay(attempt, initial=0.5, maximum=30.0):
+    # Exponential backoff with full jitter.
+    return random.uniform(0, min(maximum, initial * 2**attempt))
+
+
+async def read_stream(r, stream_name, position, count, entries):
+    while True:
+        result = await r.xread({stream_name: position}, count=count, block=30 * 1000)
+        for _, stream_items in result or []:
+            await entries.put((stream_name, stream_items))
+            position = stream_items[-1][0]
+
+
+async def write_batches(
+    connection, streams, entries, batch_size, writer, coalesce=False
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            batch = [await asyncio.wait_for(entries.get(), 1)]
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(writer, REPLICAS, connection, True)
+            continue
+        count = len(batch[0][1])
+        while count < batch_size and not entries.empty():
+            batch.append(entries.get_nowait())
+            count += len(batch[-1][1])
+        positions = dict(streams)
+        for stream_name, stream_items in batch:
+            positions[stream_name] = stream_items[-1][0]
+        await loop.run_in_executor(
+            writer,
+            lambda: apply_batch(connection, decode_batch(batch), positions, coalesce),
+        )
+        streams.update(positions)
+
+
+async def ingest_async(
+    connection, redis_url, streams, batch_size, count, prefetch, coalesce=False
+):
+    loop = asyncio.get_running_loop()
+    # All database access goes through this one thread, so the event loop
+    # is never blocked by SQLite.
+    writer = ThreadPoolExecutor(max_workers=1)
+    attempt = 0
+    while True:
+        r = redis.asyncio.Redis.from_url(redis_url)
+        entries = asyncio.Queue(maxsize=prefetch * len(streams))
+        tasks = []
+        try:
+            await r.ping()
+            logging.info("Connected.")
+            attempt = 0
+            tasks = [
+                asyncio.create_task(
+                    read_stream(r, stream_name, position, count, entries)
+                )
+                for stream_name, position in streams.items()
+            ]
+            tasks.append(
+                asyncio.create_task(
+                    write_batches(
+                        connection, streams, entries, batch_size, writer, coalesce
                     )
-                    for stream_item in stream_items:
-                        stream_event_id, zeebe_events = stream_item
-                        for zeebe_event_id, zeebe_event in zeebe_events.items():
-                            zeebe_event = json.loads(zeebe_event)
-                            if zeebe_event.get("recordType") != "EVENT":
-                                continue
-                            while True:
-                                try:
-                                    connection = apsw.Connection("dbfile")
-                                    handle_zeebe_event(
-                                        connection,
-                                        zeebe_event_type,
-                                        zeebe_event_id,
-                                        zeebe_event,
-                                    )
-                                    break
-                                finally:
-                                    try:
-                                        connection.close()
-                                    except:
-                                        pass
-                        STREAMS[stream_name] = stream_event_id
+                )
+            )
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
         except Exception as e:
             logging.exception(e)
         finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Wait for a batch still being written and resume from what it
+            # committed.
+            await loop.run_in_executor(writer, load_checkpoints, connection, streams)
             try:
-                r.close()
+                await r.close()
             except:
                 pass
-            logging.info("Reconnecting in 10 seconds.")
-            time.sleep(10)
+            delay = backoff_delay(attempt)
+            attempt += 1
+            METRICS.reconnects += 1
+            logging.info("Reconnecting in %.1f seconds.", delay)
+            await asyncio.sleep(delay)
+
+
+ARCHIVED_TABLES = [
+    "element_instance",
+    "job",
+    "variable",
+    "incident",
+    "decision_evaluation",
+    "timer",
+    "user_task",
+    "process_message_subscription",
+]
+
+
+def table_columns(connection, table):
+    cursor = connection.cursor()
+    return [row[1] for row in cursor.execute(f"PRAGMA main.table_info({table})")]
+
+
+def drop_derived(connection):
+    # Archives used to be created with the triggers and tables of init_db.
+    cursor = connection.cursor()
+    with connection:
+        for (name,) in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+        ).fetchall():
+            cursor.execute(f"DROP TRIGGER {name}")
+        cursor.execute("DROP VIEW IF EXISTS duration_percentile")
+        for name in ["counter", "duration"] + list(SEARCH):
+            cursor.execute(f"DROP TABLE IF EXISTS {name}")
+
+
+def archive_instances(connection, keys, path):
+    # Also creates the tables added since the archive was created. Archived
+    # rows are only read through the _history views, so the archive has no
+    # counters, durations or search tables to maintain.
+    archive = connect(path)
+    init_db(archive, triggers=False)
+    if schema_version(connection) == 2:
+        migrate_schema(archive, triggers=False)
+    drop_derived(archive)
+    archive.close()
+    # Copy and delete are separate transactions: in WAL mode a transaction
+    # is not atomic across attached databases. A crash between the two
+    # leaves copies, which the next run deletes before copying again:
+    # INSERT OR REPLACE would not find the variables with a NULL flowScope
+    # in their primary key.
+    schema = "archive"
+    cursor = connection.cursor()
+    cursor.execute("ATTACH DATABASE ? AS " + schema, (path,))
+    with connection:
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS archive_key(key PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.archive_key")
+        cursor.executemany("INSERT INTO temp.archive_key VALUES (?)", keys)
+        for table in ["process_instance"] + ARCHIVED_TABLES:
+            columns = ", ".join(table_columns(connection, table))
+            where = table == "process_instance" and "key" or "processInstance"
+            cursor.execute(
+                f"DELETE FROM {schema}.{table}"
+                f" WHERE {where} IN (SELECT key FROM temp.archive_key)"
+            )
+            cursor.execute(
+                f"INSERT INTO {schema}.{table} ({columns})"
+                f" SELECT {columns} FROM main.{table}"
+                f" WHERE {where} IN (SELECT key FROM temp.archive_key)"
+            )
+    with connection:
+        for table in ARCHIVED_TABLES + ["process_instance"]:
+            where = table == "process_instance" and "key" or "processInstance"
+            cursor.execute(
+                f"DELETE FROM main.{table}"
+                f" WHERE {where} IN (SELECT key FROM temp.archive_key)"
+            )
+    cursor.execute("DETACH DATABASE " + schema)
+
+
+def attach_archives(connection, directory, maximum=9):
+    # Attaches the most recent archive files and creates a temporary
+    # <table>_history view over the live and archived rows of each archived
+    # table. Works with both apsw and sqlite3 (datasette) connections.
+    # SQLite attaches at most 10 databases by default.
+    cursor = connection.cursor()
+    paths = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("archive-") and name.endswith(".db")
+    )[-maximum:]
+    attached = {row[2]: row[1] for row in cursor.execute("PRAGMA database_list")}
+    schemas = []
+    for i, path in enumerate(paths):
+        schema = attached.get(os.path.abspath(path)) or f"archive_{i}"
+        if schema not in attached.values():
+            cursor.execute("ATTACH DATABASE ? AS " + schema, (path,))
+        schemas.append(schema)
+    for table in ["process_instance"] + ARCHIVED_TABLES:
+        columns = ", ".join(table_columns(connection, table))
+        # The live rows by name, which are the federating views of
+        # attach_shards() in a sharded database.
+        sources = [table] + [
+            f"{schema}.{table}"
+            for schema in schemas
+            # Archives created before the table was added lack it.
+            if cursor.execute(
+                f"SELECT 1 FROM {schema}.sqlite_master"
+                " WHERE type = 'table' AND name = ?",
+                (table,),
+            ).fetchone()
+        ]
+        cursor.execute(
+            f"CREATE TEMP VIEW IF NOT EXISTS {table}_history AS "
+            + " UNION ALL ".join(
+                f"SELECT {columns} FROM {source}" for source in sources
+            )
+        )
+    return schemas
+
+
+# In a sharded database (importer --shards N) the Zeebe tables of the main
+# database stay empty: the records are written to <db>-shard<i>, listed in
+# its shard table, with the definitions replicated to every shard.
+REPLICATED_TABLES = ["process", "form", "decision_requirements", "decision", "resource"]
+
+
+def shard_paths(db, shards):
+    return [f"{db}-shard{i}" for i in range(shards)]
+
+
+def init_shards(connection, db, shards):
+    cursor = connection.cursor()
+    cursor.execute(
+        """\
+create table if not exists shard(
+    id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (id)
+)
+"""
+    )
+    (count,) = cursor.execute("SELECT count(*) FROM shard").fetchone()
+    if count and count != shards:
+        # Records are routed by partition modulo the number of shards.
+        raise click.ClickException(f"{db} is split into {count} shards.")
+    with connection:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO shard VALUES (?, ?)",
+            [
+                (i, os.path.basename(path))
+                for i, path in enumerate(shard_paths(db, shards))
+            ],
+        )
+
+
+def attach_shards(connection):
+    # Attaches the shards of a sharded database and creates temporary views
+    # federating them under the names of the tables and views of the main
+    # database, which they shadow. Works with both apsw and sqlite3
+    # (datasette) connections.
+    cursor = connection.cursor()
+    if not cursor.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = 'shard'"
+    ).fetchone():
+        return []
+    attached = {row[2]: row[1] for row in cursor.execute("PRAGMA database_list")}
+    directory = os.path.dirname(
+        next(path for path, schema in attached.items() if schema == "main")
+    )
+    schemas = []
+    for id_, path in cursor.execute("SELECT id, path FROM main.shard ORDER BY id"):
+        path = os.path.join(directory, path)
+        schema = attached.get(os.path.abspath(path)) or f"shard_{id_}"
+        schemas.append((schema, path))
+    for schema, path in schemas:
+        if schema not in attached.values():
+            cursor.execute("ATTACH DATABASE ? AS " + schema, (path,))
+    schemas = [schema for schema, _ in schemas]
+    if not schemas:
+        return schemas
+    for table in ZEEBE_TABLES + ["resource", "payload"]:
+        columns = ", ".join(table_columns(connection, table))
+        cursor.execute(
+            f"CREATE TEMP VIEW IF NOT EXISTS {table} AS "
+            + " UNION ALL ".join(
+                f"SELECT {columns} FROM {schema}.{table}"
+                for schema in (table in REPLICATED_TABLES and schemas[:1] or schemas)
+            )
+        )
+    cursor.execute(
+        "CREATE TEMP VIEW IF NOT EXISTS counter AS"
+        " SELECT name, key, sum(value) AS value FROM ("
+        + " UNION ALL ".join(
+            f"SELECT name, key, value FROM {schema}.counter" for schema in schemas
+        )
+        + ") GROUP BY name, key"
+    )
+    cursor.execute(
+        "CREATE TEMP VIEW IF NOT EXISTS duration AS"
+        " SELECT name, key, elementId, bucket, sum(count) AS count, sum(sum) AS sum,"
+        " min(min) AS min, max(max) AS max FROM ("
+        + " UNION ALL ".join(f"SELECT * FROM {schema}.duration" for schema in schemas)
+        + ") GROUP BY name, key, elementId, bucket"
+    )
+    # The views of the main database read its own, empty tables.
+    for (sql,) in cursor.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type = 'view' ORDER BY rowid"
+    ).fetchall():
+        cursor.execute("CREATE TEMP VIEW IF NOT EXISTS" + sql[len("CREATE VIEW") :])
+    return schemas
+
+
+# Schema 2 stores Zeebe keys and millisecond timestamps as INTEGER, with the
+# key as the rowid. It is derived from the tables created by init_db, whose
+# statements bind them as text, which INTEGER affinity converts on insert.
+ZEEBE_TABLES = [
+    "process",
+    "form",
+    "process_instance",
+    "element_instance",
+    "job",
+    "decision_requirements",
+    "decision",
+    "decision_evaluation",
+    "variable",
+    "incident",
+    "message",
+    "timer",
+    "user_task",
+    "process_message_subscription",
+]
+
+INTEGER_COLUMNS = {
+    "key",
+    "processDefinition",
+    "processInstance",
+    "parentProcessInstance",
+    "parentElementInstance",
+    "elementInstance",
+    "flowScopeKey",
+    "flowScope",
+    "decisionRequirements",
+    "decision",
+    "job",
+    "messageKey",
+    "created",
+    "updated",
+    "completed",
+}
+
+
+def schema_version(connection):
+    cursor = connection.cursor()
+    (version,) = cursor.execute("PRAGMA user_version").fetchone()
+    return version or 1
+
+
+def integer_column(table, column):
+    # form keys are form IDs, not Zeebe keys.
+    return column in INTEGER_COLUMNS and not (table == "form" and column == "key")
+
+
+def integer_table_sql(table, sql, name):
+    rowid = integer_column(table, "key") and "key TEXT NOT NULL UNIQUE" in sql
+    lines = [f"CREATE TABLE {name}("]
+    for line in sql.split("(", 1)[1].splitlines()[1:]:
+        column = line.split()[0] if line.strip() else ""
+        if rowid and line.strip() == "key TEXT NOT NULL UNIQUE,":
+            line = "    key INTEGER PRIMARY KEY,"
+        elif rowid and line.strip().startswith("PRIMARY KEY (key)"):
+            continue
+        elif rowid and line.strip().startswith("PRIMARY KEY ("):
+            line = line.replace("PRIMARY KEY", "UNIQUE")
+        elif integer_column(table, column):
+            line = line.replace(" TEXT", " INTEGER", 1)
+        lines.append(line)
+    if lines[-1].strip() == ")":
+        # The dropped primary key was the last constraint.
+        lines[-2] = lines[-2].rstrip(",")
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def write_transaction(connection):
+    # A deferred transaction that reads before it writes fails at once with
+    # SQLITE_BUSY when another connection committed meanwhile; BEGIN
+    # IMMEDIATE takes the write lock first and waits for it.
+    cursor = connection.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
+
+
+def migrate_table(connection, table, batch_size, pause, triggers=True):
+    # The new table is kept in sync by triggers while the rows are copied in
+    # small transactions, so the importer keeps writing until the final swap.
+    cursor = connection.cursor()
+    new = f"{table}_migrate"
+    (sql,) = cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    columns = table_columns(connection, table)
+    names = ", ".join(columns)
+    values = ", ".join(f"new.{column}" for column in columns)
+    primary_key = " AND ".join(
+        f"{row[1]} IS old.{row[1]}"
+        for row in cursor.execute(f"PRAGMA main.table_info({table})").fetchall()
+        if row[5]
+    )
+    with write_transaction(connection):
+        cursor.execute(f"DROP TABLE IF EXISTS {new}")
+        cursor.execute(integer_table_sql(table, sql, new))
+        cursor.execute(
+            f"CREATE TRIGGER {new}_insert AFTER INSERT ON {table} BEGIN"
+            f" INSERT OR REPLACE INTO {new} ({names}) VALUES ({values}); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {new}_update AFTER UPDATE ON {table} BEGIN"
+            f" DELETE FROM {new} WHERE {primary_key};"
+            f" INSERT OR REPLACE INTO {new} ({names}) VALUES ({values}); END"
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {new}_delete AFTER DELETE ON {table} BEGIN"
+            f" DELETE FROM {new} WHERE {primary_key}; END"
+        )
+    last = 0
+    while True:
+        with write_transaction(connection):
+            (rowid,) = cursor.execute(
+                f"SELECT max(rowid) FROM (SELECT rowid FROM {table}"
+                f" WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                (last, batch_size),
+            ).fetchone()
+            if rowid is None:
+                break
+            cursor.execute(
+                f"INSERT OR REPLACE INTO {new} ({names})"
+                f" SELECT {names} FROM {table} WHERE rowid > ? AND rowid <= ?",
+                (last, rowid),
+            )
+        last = rowid
+        time.sleep(pause)
+    with write_transaction(connection):
+        # Views are checked on rename, so they are dropped while the table is
+        # missing.
+        views = cursor.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'view'"
+        ).fetchall()
+        for name, _ in views:
+            cursor.execute(f"DROP VIEW {name}")
+        # As is the element duration trigger, reading process_instance.
+        for name in DURATIONS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}_duration_insert")
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}_duration_update")
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {new} RENAME TO {table}")
+        for _, sql in views:
+            cursor.execute(sql)
+        init_indexes(connection)
+        if triggers:
+            init_counters(connection)
+            init_durations(connection)
+            init_search(connection)
+            rebuild_search(
+                connection,
+                [name for name, search in SEARCH.items() if search[0] == table],
+            )
+
+
+def migrate_schema(connection, batch_size=10000, pause=0.05, triggers=True):
+    cursor = connection.cursor()
+    for table in ZEEBE_TABLES:
+        if any(
+            integer_column(table, row[1]) and row[2] == "TEXT"
+            for row in cursor.execute(f"PRAGMA main.table_info({table})").fetchall()
+        ):
+            logging.info("Migrating %s.", table)
+            migrate_table(connection, table, batch_size, pause, triggers)
+    with connection:
+        for table in ZEEBE_TABLES:
+            # Keys and timestamps as text, as in schema 1.
+            columns = ", ".join(
+                integer_column(table, row[1])
+                and row[2] == "INTEGER"
+                and f"CAST({row[1]} AS TEXT) AS {row[1]}"
+                or row[1]
+                for row in cursor.execute(f"PRAGMA main.table_info({table})").fetchall()
+            )
+            cursor.execute(
+                f"CREATE VIEW IF NOT EXISTS {table}_v1 AS SELECT {columns} FROM {table}"
+            )
+        cursor.execute("PRAGMA user_version = 2")
+
+
+# The streams the importer reads, and checkpoints.
+ZEEBE_STREAMS = [
+    b"zeebe:DECISION",
+    b"zeebe:DECISION_EVALUATION",
+    b"zeebe:DECISION_REQUIREMENTS",
+    b"zeebe:INCIDENT",
+    b"zeebe:JOB",
+    b"zeebe:MESSAGE",
+    b"zeebe:PROCESS",
+    b"zeebe:PROCESS_INSTANCE",
+    b"zeebe:PROCESS_MESSAGE_SUBSCRIPTION",
+    b"zeebe:TIMER",
+    b"zeebe:USER_TASK",
+    b"zeebe:VARIABLE",
+]
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+@click.option("--db", default="dbfile", show_default=True, help="SQLite database.")
+@click.option(
+    "--redis-url",
+    default="redis://localhost:6379/0",
+    show_default=True,
+    help="Redis holding the zeebe:* streams.",
+)
+@click.option(
+    "--storage-profile",
+    type=click.Choice(["rollback", "wal"]),
+    default="wal",
+    show_default=True,
+    help="Journal mode and pragmas applied when the database is opened.",
+)
+@click.option(
+    "--wal-checkpoint-interval",
+    default=10.0,
+    show_default=True,
+    help="Seconds between passive WAL checkpoints run between batches. "
+    "0 leaves checkpointing to SQLite.",
+)
+@click.option(
+    "--wal-truncate-pages",
+    default=10000,
+    show_default=True,
+    help="Truncate the WAL when a checkpoint finds at least this many pages in it.",
+)
+@click.option(
+    "--batch-size",
+    default=1000,
+    show_default=True,
+    help="Maximum number of stream entries applied in one transaction.",
+)
+@click.option(
+    "--batch-latency",
+    default=0.1,
+    show_default=True,
+    help="Maximum seconds to wait for a batch to fill up before committing it.",
+)
+@click.option(
+    "--replay",
+    is_flag=True,
+    help="Discard stored stream checkpoints and replay all streams from 0.",
+)
+@click.option(
+    "--definition-cache-size",
+    default=128,
+    show_default=True,
+    help="Maximum number of parsed process definitions kept in memory.",
+)
+@click.option(
+    "--workers",
+    default=0,
+    show_default=True,
+    help="Decode events in this many worker processes while the next batch is "
+    "read and the previous one is written. 0 disables pipelining.",
+)
+@click.option(
+    "--prefetch",
+    default=2,
+    show_default=True,
+    help="Maximum number of batches read ahead of the writer when pipelining.",
+)
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Read the streams concurrently with redis.asyncio.",
+)
+@click.option(
+    "--count",
+    default=100,
+    show_default=True,
+    help="Maximum number of entries per stream read (asyncio mode).",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    help="Serve Prometheus metrics over HTTP on this port.",
+)
+@click.option(
+    "--coalesce",
+    is_flag=True,
+    help="Write only the final state of each row changed within a batch.",
+)
+@click.option(
+    "--payload-threshold",
+    default=PAYLOAD_THRESHOLD,
+    show_default=True,
+    help="Store variable values and job variables longer than this once, "
+    "compressed, in the payload table (0 disables).",
+)
+@click.option(
+    "--watermark-channel",
+    default=watermark.CHANNEL,
+    show_default=True,
+    help="Redis channel to publish the stream positions and Zeebe keys of "
+    "each committed batch to (empty disables).",
+)
+@click.option(
+    "--trim-lag",
+    type=float,
+    help="Trim the zeebe:* streams (XTRIM MINID ~) after each committed batch, "
+    "keeping the entries of this many seconds before the last applied ones. "
+    "Not trimmed by default.",
+)
+@click.option(
+    "--consumer-group",
+    help="Read the zeebe:* streams through this consumer group and XACK the "
+    "entries of each committed batch, for the exporter to trim them.",
+)
+@click.option(
+    "--shards",
+    default=0,
+    show_default=True,
+    help="Split the records by Zeebe partition into this many databases, "
+    "<db>-shard<N>, each imported by its own process. 0 imports them all "
+    "into the database.",
+)
+@click.option(
+    "--shard",
+    type=int,
+    help="Import only this shard of --shards, as the processes that --shards "
+    "starts do.",
+)
+@click.option(
+    "--replica",
+    "replicas",
+    multiple=True,
+    help="Keep this read-only copy of the database for datasette --immutable, "
+    "replaced with a new snapshot every --replica-interval seconds. Can be "
+    "given more than once.",
+)
+@click.option(
+    "--replica-interval",
+    default=60.0,
+    show_default=True,
+    help="Minimum seconds between the starts of two replica snapshots.",
+)
+@click.option(
+    "--replica-pages",
+    default=1000,
+    show_default=True,
+    help="Database pages copied into the next replica snapshot between batches.",
+)
+def main(
+    ctx,
+    db,
+    redis_url,
+    storage_profile,
+    wal_checkpoint_interval,
+    wal_truncate_pages,
+    batch_size,
+    batch_latency,
+    replay,
+    definition_cache_size,
+    workers,
+    prefetch,
+    use_async,
+    count,
+    metrics_port,
+    coalesce,
+    payload_threshold,
+    watermark_channel,
+    trim_lag,
+    consumer_group,
+    shards,
+    shard,
+    replicas,
+    replica_interval,
+    replica_pages,
+):
+    """Import Zeebe records from the zeebe:* Redis streams into SQLite."""
+    if ctx.invoked_subcommand is not None:
+        return
+    if shards and (workers or use_async):
+        raise click.UsageError("--shards cannot be combined with --workers or --async.")
+    if shard is not None and not 0 <= shard < shards:
+        raise click.UsageError("--shard must be below --shards.")
+    if consumer_group and (trim_lag is not None or use_async):
+        raise click.UsageError(
+            "--consumer-group cannot be combined with --trim-lag or --async."
+        )
+    if shards and replicas:
+        raise click.UsageError("--replica cannot be combined with --shards.")
+    for path in replicas:
+        if os.path.abspath(path) == os.path.abspath(db):
+            raise click.UsageError("--replica must not be the database itself.")
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            raise click.UsageError(f"The directory of --replica {path} does not exist.")
+    if shards and not shard:
+        # The database itself only lists the shards, for attach_shards(). It
+        # is written before the shard processes start, and by shard 0 when
+        # they are run on their own.
+        connection = connect(db, storage_profile)
+        init_db(connection)
+        init_shards(connection, db, shards)
+        connection.close()
+    if shard is not None:
+        SHARD.shard = shard
+        SHARD.shards = shards
+        paths = shard_paths(db, shards)
+        db = paths[shard]
+        metrics_port = metrics_port and metrics_port + shard
+        consumer_group = consumer_group and f"{consumer_group}-shard{shard}"
+        # Shard 0 trims what all shards have applied.
+        STREAM_TRIM.shards = paths[1:]
+        if shard:
+            trim_lag = None
+    elif shards:
+        processes = [
+            multiprocessing.Process(target=run_shard, args=(ctx.params, i))
+            for i in range(shards)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            # A shard process only stops on an error; the others would go on
+            # importing their shards while that one falls behind.
+            ready = multiprocessing.connection.wait([p.sentinel for p in processes])
+            for i, process in enumerate(processes):
+                if process.sentinel in ready:
+                    process.join()
+                    raise click.ClickException(
+                        f"Shard {i} exited with code {process.exitcode}."
+                    )
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+        return
+    STREAMS = {name: 0 for name in ZEEBE_STREAMS}
+    DEFINITIONS.maxsize = definition_cache_size
+    set_payload_threshold(payload_threshold)
+    WAL_CHECKPOINT.interval = wal_checkpoint_interval
+    WAL_CHECKPOINT.truncate_pages = wal_truncate_pages
+    REPLICAS.paths = list(replicas)
+    REPLICAS.interval = replica_interval
+    REPLICAS.pages = replica_pages
+    connection = connect(db, storage_profile)
+    if wal_checkpoint_interval:
+        connection.wal_autocheckpoint(0)
+    init_db(connection)
+    for query, index, plan in check_query_plans(connection):
+        logging.warning("Query does not use index %s: %s %s", index, query, plan)
+    if replay:
+        connection.cursor().execute("DELETE FROM checkpoint")
+    load_checkpoints(connection, STREAMS)
+    logging.debug(STREAMS)
+    if metrics_port:
+        METRICS.serve(metrics_port, STREAMS, redis_url)
+    if watermark_channel:
+        WATERMARK.channel = watermark_channel
+        WATERMARK.client = redis.Redis.from_url(redis_url)
+    if trim_lag is not None:
+        STREAM_TRIM.lag = trim_lag
+        STREAM_TRIM.client = redis.Redis.from_url(redis_url)
+
+    if use_async:
+        try:
+            asyncio.run(
+                ingest_async(
+                    connection,
+                    redis_url,
+                    STREAMS,
+                    batch_size,
+                    count,
+                    prefetch,
+                    coalesce,
+                )
+            )
+        finally:
+            REPLICAS.close()
+            connection.close()
+        return
+
+    try:
+        while True:
+            try:
+                r = redis.Redis.from_url(redis_url)
+                if consumer_group:
+                    r = STREAM_TRIM.group = ConsumerGroup(r, consumer_group, STREAMS)
+                logging.info("Connected.")
+                if workers:
+                    ingest_pipelined(
+                        connection,
+                        r,
+                        STREAMS,
+                        batch_size,
+                        batch_latency,
+                        workers,
+                        prefetch,
+                        coalesce,
+                    )
+                else:
+                    ingest(connection, r, STREAMS, batch_size, batch_latency, coalesce)
+            except Exception as e:
+                logging.exception(e)
+                METRICS.reconnects += 1
+                logging.info("Reconnecting in 10 seconds.")
+                time.sleep(10)
+            finally:
+                try:
+                    r.close()
+                except:
+                    pass
+    finally:
+        REPLICAS.close()
+        connection.close()
+
+
+def run_shard(params, shard):
+    with main.make_context("importer", []) as ctx:
+        ctx.invoke(main, **dict(params, shard=shard))
+
+
+@main.command()
+@click.argument("events", type=click.File("r"))
+@click.option("--db", default="dbfile", show_default=True, help="New SQLite database.")
+@click.option(
+    "--batch-size",
+    default=10000,
+    show_default=True,
+    help="Number of records loaded per transaction.",
+)
+def backfill(events, db, batch_size):
+    """Load a new database from a JSON lines dump of the zeebe:* streams.
+
+    Each line is a {"stream": "zeebe:...", "id": ..., "event": ...} record,
+    where event is the exported Zeebe record (as an object or a JSON string)
+    and id is its optional stream entry ID.
+    """
+    if os.path.exists(db):
+        raise click.ClickException(f"{db} already exists.")
+    connection = connect(db, "bulk")
+    init_db(connection, indexes=False, triggers=False)
+    batch = []
+    positions = {}
+    for line in events:
+        if not line.strip():
+            continue
+        record = loads(line)
+        stream_name = record["stream"].encode("utf-8")
+        if record.get("id") and stream_name in ZEEBE_STREAMS:
+            positions[stream_name] = str(record["id"]).encode("utf-8")
+        zeebe_event = record["event"]
+        if isinstance(zeebe_event, str):
+            zeebe_event = decode_event(zeebe_event.encode("utf-8"))
+        else:
+            zeebe_event = event_from_record(zeebe_event)
+        if zeebe_event is not None:
+            batch.append(
+                (
+                    stream_name,
+                    [make_record(zeebe_event_type(stream_name), None, zeebe_event)],
+                )
+            )
+        if len(batch) >= batch_size:
+            apply_batch(connection, batch, positions)
+            batch = []
+    with connection:
+        apply_records(connection, [r for _, records in batch for r in records])
+        save_checkpoints(connection, positions)
+    logging.info("Creating indexes.")
+    init_indexes(connection)
+    init_counters(connection)
+    init_durations(connection)
+    rebuild_counters(connection)
+    rebuild_durations(connection)
+    init_search(connection)
+    connection.cursor().execute("PRAGMA optimize")
+    connection.close()
+
+
+@main.command("rebuild-counters")
+@click.option("--db", default="dbfile", show_default=True, help="SQLite database.")
+def rebuild_counters_command(db):
+    """Recompute the dashboard counters and duration statistics from the tables."""
+    connection = connect(db)
+    init_db(connection)
+    rebuild_counters(connection)
+    rebuild_durations(connection)
+    connection.close()
+
+
+@main.command("rebuild-search")
+@click.option("--db", default="dbfile", show_default=True, help="SQLite database.")
+def rebuild_search_command(db):
+    """Rebuild the full text search tables, e.g. after a VACUUM."""
+    connection = connect(db)
+    init_db(connection)
+    rebuild_search(connection)
+    connection.close()
+
+
+@main.command()
+@click.option("--db", default="dbfile", show_default=True, help="SQLite database.")
+@click.option(
+    "--batch-size",
+    default=10000,
+    show_default=True,
+    help="Number of rows copied per transaction.",
+)
+@click.option(
+    "--pause",
+    default=0.05,
+    show_default=True,
+    help="Seconds to sleep between transactions, to let the importer write.",
+)
+def migrate(db, batch_size, pause):
+    """Migrate the database to the INTEGER key and timestamp schema 2."""
+    connection = connect(db)
+    init_db(connection)
+    migrate_schema(connection, batch_size, pause)
+    connection.close()
+
+
+@main.command()
+@click.option("--db", default="dbfile", show_default=True, help="SQLite database.")
+@click.option(
+    "--days",
+    default=30,
+    show_default=True,
+    help="Archive process instances completed more than this many days ago.",
+)
+@click.option(
+    "--directory",
+    default="archive",
+    show_default=True,
+    help="Directory of the archive databases.",
+)
+@click.option(
+    "--partition",
+    default="%Y",
+    show_default=True,
+    help="strftime format of the completion time naming the archive database.",
+)
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    help="Number of process instances moved per transaction.",
+)
+@click.option(
+    "--pause",
+    default=0.05,
+    show_default=True,
+    help="Seconds to sleep between transactions, to let the importer write.",
+)
+@click.option(
+    "--vacuum-pages",
+    default=1000,
+    show_default=True,
+    help="Number of free pages released per incremental vacuum step.",
+)
+def archive(db, days, directory, partition, batch_size, pause, vacuum_pages):
+    """Move completed process instances into archive databases."""
+    os.makedirs(directory, exist_ok=True)
+    connection = connect(db)
+    init_db(connection)
+    cursor = connection.cursor()
+    cutoff = str(int((time.time() - days * 24 * 60 * 60) * 1000))
+    archived = 0
+    while True:
+        instances = cursor.execute(
+            "SELECT key, completed FROM process_instance"
+            " WHERE completed IS NOT NULL AND completed < ?"
+            " ORDER BY completed LIMIT ?",
+            (cutoff, batch_size),
+        ).fetchall()
+        if not instances:
+            break
+        partitions = defaultdict(list)
+        for key, completed in instances:
+            name = time.strftime(partition, time.gmtime(int(completed) / 1000))
+            partitions[name].append((key,))
+        for name, keys in sorted(partitions.items()):
+            path = os.path.join(directory, f"archive-{name}.db")
+            archive_instances(connection, keys, path)
+            archived += len(keys)
+        logging.info("Archived %d process instances.", archived)
+        time.sleep(pause)
+    (auto_vacuum,) = cursor.execute("PRAGMA auto_vacuum").fetchone()
+    if auto_vacuum != 2:
+        logging.info("Run VACUUM once to enable incremental vacuum and reclaim space.")
+    else:
+        while cursor.execute("PRAGMA freelist_count").fetchone()[0]:
+            cursor.execute(f"PRAGMA incremental_vacuum({vacuum_pages})").fetchall()
+            time.sleep(pause)
+    connection.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+import os
+
+from datasette import hookimpl
+
+from importer import attach_archives, attach_shards
+
+ARCHIVE_DIRECTORY = os.environ.get("ARCHIVE_DIRECTORY", "archive")
+
+
+@hookimpl
+def prepare_connection(conn, database):
+    if database == "dbfile" and os.path.isdir(ARCHIVE_DIRECTORY):
+        # The history views read the live rows through the shard views.
+        shards = attach_shards(conn)
+        attach_archives(conn, ARCHIVE_DIRECTORY, maximum=9 - len(shards))
@@ -0,0 +1,8 @@
+from datasette import hookimpl
+
+from importer import inflate_text
+
+
+@hookimpl
+def prepare_connection(conn):
+    conn.create_function("inflate_text", 1, inflate_text, deterministic=True)
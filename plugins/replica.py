@@ -0,0 +1,69 @@
+import os
+
+import datasette.database
+from datasette import hookimpl
+from datasette.database import Database
+
+# The importer replaces its --replica files with new snapshots, but datasette
+# keeps the connections to an immutable (datasette -i) database open, and
+# caches its table counts. An immutable database whose file was replaced is
+# opened again on the next request.
+FILES = {}
+
+
+class Replica(Database):
+    # The read threads keep their connections by database name, so a thread
+    # that read the replaced file still has its connection.
+    async def execute_fn(self, fn):
+        def reopened(conn):
+            if conn not in self._all_file_connections:
+                conn.close()
+                conn = self.connect()
+                self.ds._prepare_connection(conn, self.name)
+                setattr(datasette.database.connections, self.name, conn)
+            return fn(conn)
+
+        return await super().execute_fn(reopened)
+
+
+def file_id(path):
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def reopen_replaced(ds):
+    for name, database in list(ds.databases.items()):
+        if database.is_mutable or database.is_memory:
+            continue
+        try:
+            current = file_id(database.path)
+        except FileNotFoundError:
+            continue
+        if FILES.setdefault(name, current) == current:
+            continue
+        FILES[name] = current
+        ds.remove_database(name)
+        ds.add_database(
+            Replica(ds, path=database.path, is_mutable=False),
+            name=name,
+            route=database.route,
+        )
+
+
+@hookimpl
+def startup(datasette):
+    for name, database in datasette.databases.items():
+        if not database.is_mutable and not database.is_memory:
+            FILES[name] = file_id(database.path)
+
+
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap(app):
+        async def reopening(scope, receive, send):
+            reopen_replaced(datasette)
+            await app(scope, receive, send)
+
+        return reopening
+
+    return wrap
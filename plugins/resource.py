@@ -0,0 +1,8 @@
+from datasette import hookimpl
+
+from importer import inflate_base64
+
+
+@hookimpl
+def prepare_connection(conn):
+    conn.create_function("inflate_base64", 1, inflate_base64, deterministic=True)
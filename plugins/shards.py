@@ -0,0 +1,57 @@
+import re
+
+import datasette.database
+import datasette.utils
+import sqlite_utils
+from datasette import hookimpl
+
+from importer import attach_shards
+
+# The temporary views of attach_shards() shadow the empty tables of the main
+# database, and the unqualified PRAGMAs datasette and datasette-graphql
+# (through sqlite-utils) introspect them with would find the views, without
+# primary or foreign keys. Only the connections with these views, those of
+# the sharded database, introspect the main schema instead.
+INTROSPECTION = re.compile(
+    r"^(\s*PRAGMA\s+)(table_x?info|foreign_key_list|index_list)\b", re.IGNORECASE
+)
+
+SHARD_VIEWS = "SELECT 1 FROM temp.sqlite_master WHERE type = 'view' LIMIT 1"
+
+
+def main_schema(conn, sql):
+    if INTROSPECTION.match(sql) and conn.execute(SHARD_VIEWS).fetchone():
+        return INTROSPECTION.sub(r"\1main.\2", sql, count=1)
+    return sql
+
+
+class MainSchema:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, *args):
+        return self.conn.execute(main_schema(self.conn, sql), *args)
+
+
+def introspect_main(function):
+    def wrapper(conn, table):
+        return function(MainSchema(conn), table)
+
+    return wrapper
+
+
+for name in ("table_column_details", "get_outbound_foreign_keys"):
+    function = introspect_main(getattr(datasette.utils, name))
+    setattr(datasette.utils, name, function)
+    setattr(datasette.database, name, function)
+
+sqlite_utils_execute = sqlite_utils.Database.execute
+sqlite_utils.Database.execute = lambda self, sql, *args: sqlite_utils_execute(
+    self, main_schema(self.conn, sql), *args
+)
+
+
+@hookimpl
+def prepare_connection(conn, database):
+    if database == "dbfile":
+        attach_shards(conn)
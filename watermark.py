@@ -0,0 +1,44 @@
+import json
+import time
+
+CHANNEL = "importer:watermark"
+
+
+def encode(positions, keys):
+    return json.dumps(
+        {
+            "positions": {
+                stream.decode("utf-8"): position.decode("utf-8")
+                for stream, position in positions.items()
+            },
+            "keys": sorted(keys),
+        }
+    )
+
+
+def wait_until_visible(r, keys, timeout=10.0, visible=None, channel=CHANNEL):
+    # Blocks until the importer has committed the given Zeebe keys (process
+    # instance, element instance, job, incident, ...), or timeout seconds.
+    # visible() is checked once subscribed, for keys committed before that.
+    if isinstance(keys, (int, str)):
+        keys = [keys]
+    keys = {str(key) for key in keys}
+    deadline = time.monotonic() + timeout
+    pubsub = r.pubsub()
+    try:
+        pubsub.subscribe(channel)
+        while keys:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            message = pubsub.get_message(timeout=remaining)
+            if message is None:
+                continue
+            if message["type"] == "subscribe":
+                if visible is not None and visible():
+                    return True
+            elif message["type"] == "message":
+                keys -= set(json.loads(message["data"])["keys"])
+        return True
+    finally:
+        pubsub.close()